@@ -0,0 +1,625 @@
+import os
+import time
+import random
+import shutil
+import asyncio
+import logging
+import tempfile
+from aiohttp import web, ClientSession, TCPConnector
+from slack_sdk.web.async_client import AsyncWebClient
+from slack_sdk.socket_mode.aiohttp import SocketModeClient
+from slack_sdk.socket_mode.response import SocketModeResponse
+from telebot.async_telebot import AsyncTeleBot
+from telebot import types, asyncio_helper
+import utils
+import metrics
+from signing import verify_slack_signature
+from coalescer import EditCoalescer
+from storage import EventDeduper
+from socket_mode import get_socket_mode_app_tokens
+from outbound import DEFAULT_RATE_LIMITS, TokenBucket, get_retry_after
+from media import CHUNK_SIZE, ALBUM_MIMETYPES, MediaTooLarge, group_slack_files
+
+# Asyncio runtime of the gate: Telegram long polling, the /slack/events receiver and
+# Slack API calls share one event loop and one aiohttp connection pool.
+# Routing, message mappings and the Slack user cache are shared with utils.py.
+
+MEDIA_CONTENT_TYPES = ['photo', 'document', 'audio', 'video', 'animation', 'voice']
+
+# Token buckets of outbound.py for coroutines: waits for tokens with asyncio.sleep
+# and retries rate-limited calls after Retry-After
+class AsyncRateLimiter:
+    def __init__(self, rate_limits=None, max_attempts=5):
+        self.rate_limits = dict(DEFAULT_RATE_LIMITS)
+        self.rate_limits.update(rate_limits or {})
+        self.max_attempts = max_attempts
+        self._buckets = {}
+
+    def _bucket(self, key):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            rate, capacity = self.rate_limits[key[0]]
+            bucket = self._buckets[key] = TokenBucket(rate, capacity)
+        return bucket
+
+    async def acquire(self, keys):
+        buckets = [self._bucket(tuple(key)) for key in keys]
+        while True:
+            wait = max([bucket.wait_time(time.monotonic()) for bucket in buckets], default=0)
+            if wait <= 0:
+                for bucket in buckets:
+                    bucket.take()
+                return
+            await asyncio.sleep(wait)
+
+    async def call(self, keys, func, *args, **kwargs):
+        attempts = 0
+        while True:
+            await self.acquire(keys)
+            attempts += 1
+            api = keys[0][0] if keys else 'other'
+            started = time.monotonic()
+            try:
+                result = await func(*args, **kwargs)
+                metrics.api_calls.observe(time.monotonic() - started, api=api)
+                return result
+            except Exception as e:
+                metrics.api_calls.observe(time.monotonic() - started, api=api)
+                metrics.api_errors.inc(api=api)
+                retry_after = get_retry_after(e)
+                if retry_after is not None:
+                    metrics.api_rate_limited.inc(api=api)
+                if retry_after is None or attempts >= self.max_attempts:
+                    raise
+                until = time.monotonic() + retry_after
+                for key in keys:
+                    self._bucket(tuple(key)).block(until)
+                logging.warning(f"Outbound call {getattr(func, '__name__', func)} rate limited, retry {attempts} in {retry_after:.1f}s")
+                await asyncio.sleep(retry_after + random.uniform(0, retry_after * 0.1 + 0.5))
+
+def telegram_keys(project):
+    return [('telegram',), ('telegram_chat', str(project['telegram_chat_id']))]
+
+def slack_keys(project, method):
+    return [(f'slack_{method}', project['slack_channel_id'])]
+
+class AsyncBridge:
+    def __init__(self, config):
+        settings = config['settings']
+        self.settings = settings
+        self.telegram_token = settings['telegram_bot_gate_token']
+        self.slack_api_url = utils.get_slack_api_url(settings)
+        telegram_api_url = utils.get_telegram_api_url(settings)
+        asyncio_helper.API_URL = telegram_api_url + '/bot{0}/{1}'
+        asyncio_helper.FILE_URL = telegram_api_url + '/file/bot{0}/{1}'
+        self.bot = AsyncTeleBot(self.telegram_token)
+        self.limiter = AsyncRateLimiter(
+            {name: tuple(limit) for name, limit in (settings.get('rate_limits') or {}).items()}
+        )
+        self.in_flight = asyncio.Semaphore(settings.get('async_max_in_flight', 1000))
+        self.media_slots = asyncio.Semaphore(settings.get('media_max_concurrent', 4))
+        self.media_max_size = settings.get('media_max_size', 50 * 1024 * 1024)
+        self.media_memory_limit = settings.get('media_memory_limit', 1024 * 1024)
+        self.http = None
+        self.slack_clients = {}
+        self.lanes = {}
+        self.tasks = set()
+        self.loop = None
+        self.socket_mode_clients = {}
+        self.edit_coalescer = EditCoalescer(window=settings.get('edit_window', 1.0))
+        self.event_deduper = None
+
+        self.bot.message_handler(content_types=['text'] + MEDIA_CONTENT_TYPES)(self.on_telegram_message)
+        self.bot.edited_message_handler(content_types=['text'] + MEDIA_CONTENT_TYPES)(self.on_telegram_message_edit)
+
+    # AsyncWebClient per bot token, all of them use the shared aiohttp session
+    def get_slack_client(self, slack_bot_token):
+        slack_client = self.slack_clients.get(slack_bot_token)
+        if slack_client is None:
+            slack_client = self.slack_clients[slack_bot_token] = AsyncWebClient(token=slack_bot_token, session=self.http, base_url=self.slack_api_url)
+        return slack_client
+
+    # Run a coroutine in the background, in order with the other coroutines of its lane
+    def spawn(self, lane, coro):
+        task = asyncio.create_task(self._run_in_lane(lane, coro))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    # Pass an edit through the coalescer, the latest edit of a target runs in its lane
+    def submit_edit(self, target, lane, handler, arg):
+        self.edit_coalescer.submit(target, self.loop.call_soon_threadsafe, self.spawn_edit, lane, handler, arg)
+
+    def spawn_edit(self, lane, handler, arg):
+        self.spawn(lane, handler(arg))
+
+    async def _run_in_lane(self, lane, coro):
+        lock = self.lanes.get(lane)
+        if lock is None:
+            lock = self.lanes[lane] = asyncio.Lock()
+        # The lane comes first, so tasks waiting behind a busy lane do not hold in-flight slots
+        async with lock:
+            async with self.in_flight:
+                try:
+                    await coro
+                except Exception as e:
+                    logging.error(f"Error processing event in lane {lane}: {str(e)}")
+
+    async def get_slack_username(self, slack_bot_token, slack_user_id):
+        slack_username = utils.user_cache.peek(slack_bot_token, slack_user_id)
+        if slack_username is None:
+            # users.info through the shared cache, so concurrent misses are fetched once
+            slack_username = await asyncio.to_thread(
+                utils.get_slack_username, utils.get_slack_client(slack_bot_token), slack_user_id
+            )
+        return slack_username
+
+    # Route to receive events from Slack
+    async def slack_event_handler(self, request):
+        signing_secret = self.settings.get('slack_signing_secret')
+        if signing_secret and not verify_slack_signature(
+            signing_secret,
+            request.headers.get('X-Slack-Request-Timestamp'),
+            await request.read(),
+            request.headers.get('X-Slack-Signature')
+        ):
+            logging.warning("Slack request with a wrong signature rejected")
+            return web.Response(status=401)
+
+        try:
+            data = await request.json()
+
+            # Process challenge from Slack (during initial setup)
+            if 'challenge' in data:
+                return web.json_response({'challenge': data['challenge']})
+
+            if 'event' in data:
+                self.receive_slack_event(data['event'], data.get('event_id'))
+        except Exception as e:
+            logging.error(f"Error receiving Slack event: {str(e)}")
+
+        return web.Response(status=200)
+
+    # Slack events from /slack/events and Socket Mode
+    @metrics.stage_seconds.time(stage='ingest')
+    def receive_slack_event(self, event, event_id=None):
+        channel_id = event.get('channel')
+        # Slack retries are rejected before they take a lane
+        if not self.event_deduper.check_and_mark(event_id, channel_id, event.get('ts')):
+            logging.debug(f"Duplicate Slack event {event_id} skipped")
+            return
+        project = utils.find_project_by_slack_channel(channel_id) if channel_id else None
+        lane = (project['project_name'] if project else None, channel_id)
+        if event.get('subtype') == 'message_changed':
+            if project and event['message'].get('text') != event['previous_message'].get('text'):
+                self.submit_edit((project['project_name'], 'slack', event['previous_message']['ts']), lane, self.process_slack_event, event)
+        else:
+            self.spawn(lane, self.process_slack_event(event))
+
+    # One Socket Mode connection per app token of the projects with slack_ingestion: socket
+    async def sync_socket_mode(self, config):
+        tokens = get_socket_mode_app_tokens(config)
+        for app_token in set(self.socket_mode_clients) - tokens:
+            await self.socket_mode_clients.pop(app_token).close()
+        for app_token in tokens - set(self.socket_mode_clients):
+            client = SocketModeClient(
+                app_token=app_token,
+                web_client=AsyncWebClient(session=self.http, base_url=self.slack_api_url)
+            )
+            client.socket_mode_request_listeners.append(self.on_socket_mode_request)
+            try:
+                await client.connect()
+                self.socket_mode_clients[app_token] = client
+            except Exception as e:
+                logging.error(f"Error opening a Socket Mode connection: {str(e)}")
+
+    async def on_socket_mode_request(self, client, request):
+        # Slack redelivers envelopes that are not acknowledged within 3 seconds
+        await client.send_socket_mode_response(SocketModeResponse(envelope_id=request.envelope_id))
+        if request.type == 'events_api' and 'event' in request.payload:
+            self.receive_slack_event(request.payload['event'], request.payload.get('event_id'))
+
+    async def metrics_handler(self, request):
+        return web.Response(text=metrics.render(), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+    # Route to receive updates from Telegram in webhook mode
+    async def telegram_webhook_handler(self, request):
+        secret = self.settings.get('telegram_webhook_secret')
+        if not secret or request.headers.get('X-Telegram-Bot-Api-Secret-Token') != secret:
+            logging.warning("Telegram webhook request with a wrong secret token rejected")
+            return web.Response(status=403)
+
+        try:
+            update = types.Update.de_json(await request.text())
+            await self.bot.process_new_updates([update])
+        except Exception as e:
+            logging.error(f"Error processing Telegram webhook update: {str(e)}")
+
+        return web.Response(status=200)
+
+    async def process_slack_event(self, event):
+        if event.get('subtype') == 'message_changed':
+            await self.handle_slack_message_changed(event)
+        elif event.get('type') == 'user_change':
+            utils.user_cache.invalidate(event['user']['id'])
+        elif event.get('type') == 'message':
+            await self.handle_slack_message(event)
+        else:
+            logging.debug(f"Skipping an irrelevant Slack event: {event['type']}")
+
+    async def handle_slack_message(self, event):
+        project = utils.find_project_by_slack_channel(event['channel'])
+        if event.get('files'):
+            await asyncio.to_thread(utils.update_slack_thread_ts_by_string, event, project)
+
+        if not project or not project['active']:
+            logging.warning(f"Project not found or not active for Slack channel_id={event['channel']}")
+            return
+        slack_bot_member_id = project.get('slack_bot_member_id') or await asyncio.to_thread(utils.get_project_bot_member_id, project)
+        if event.get('user') == slack_bot_member_id:
+            logging.debug(f"Message sent by Slack bot {slack_bot_member_id}, skip forwarding.")
+            return
+
+        slack_token = project['slack_bot_token']
+        slack_user_id = event.get('user')
+        slack_username = await self.get_slack_username(slack_token, slack_user_id)
+        slack_user_id_tag = f"<@{slack_user_id}>"
+        # Mapping lookups may hit the database, which is kept off the event loop
+        reply_to_message_id, thread_ts = await asyncio.to_thread(utils.process_reply_to_message, event, project)
+
+        try:
+            if 'files' in event:
+                caption = f"{slack_username} \n{slack_user_id_tag}"
+                if event.get('text'):
+                    caption += f"\n\n{event['text']}"
+                telegram_message_ids = await self.send_files_to_telegram(
+                    event['files'], slack_token, caption, project, reply_to_message_id
+                )
+                for telegram_message_id in telegram_message_ids:
+                    utils.save_thread_ts(telegram_message_id, thread_ts, project['project_name'])
+                metrics.messages_bridged.inc(project=project['project_name'], direction='slack_to_telegram', content_type='file')
+            else:
+                telegram_message = f"{slack_username} \n{slack_user_id_tag}\n\n{event['text']}"
+                telegram_response = await self.limiter.call(
+                    telegram_keys(project), self.bot.send_message,
+                    project['telegram_chat_id'], telegram_message,
+                    reply_to_message_id=reply_to_message_id
+                )
+                utils.save_thread_ts(telegram_response.message_id, thread_ts, project['project_name'])
+                metrics.messages_bridged.inc(project=project['project_name'], direction='slack_to_telegram', content_type='text')
+        except Exception as e:
+            logging.error(f"Error when sending a message to Telegram for a project {project['project_name']}: {str(e)}")
+
+    async def handle_slack_message_changed(self, event):
+        project = utils.find_project_by_slack_channel(event['channel'])
+        if not project or not project['active']:
+            return
+
+        slack_user_id = event['message'].get('user')
+        slack_username = await self.get_slack_username(project['slack_bot_token'], slack_user_id)
+        telegram_message_id = await asyncio.to_thread(
+            utils.get_telegram_message_id_by_thread_ts, event['previous_message']['ts'], project['project_name']
+        )
+        text = f"{slack_username} \n<@{slack_user_id}>\n\n{event['message']['text']}"
+        target = (project['project_name'], 'slack', event['previous_message']['ts'])
+        if self.edit_coalescer.is_unchanged(target, text):
+            return
+        try:
+            if event['message'].get('files'):
+                await self.limiter.call(
+                    telegram_keys(project), self.bot.edit_message_caption,
+                    chat_id=project['telegram_chat_id'],
+                    message_id=telegram_message_id,
+                    caption=text
+                )
+            else:
+                await self.limiter.call(
+                    telegram_keys(project), self.bot.edit_message_text,
+                    chat_id=project['telegram_chat_id'],
+                    message_id=telegram_message_id,
+                    text=text
+                )
+            self.edit_coalescer.remember(target, text)
+        except Exception as e:
+            logging.error(f"Error when editing Telegram message: {str(e)}")
+
+    # Same parts as the thread runtime: photos and videos go as albums, other files as
+    # documents, the caption goes with the first part. Returns the Telegram message ids.
+    async def send_files_to_telegram(self, files, slack_token, caption, project, reply_to_message_id):
+        parts = group_slack_files(files, self.media_max_size)
+        local_files = await asyncio.gather(*[
+            self.download_slack_file(file['url_private'], slack_token) for part in parts for file in part
+        ])
+        telegram_message_ids = []
+        failed_parts = 0
+        try:
+            part_start = 0
+            for part in parts:
+                part_files = local_files[part_start:part_start + len(part)]
+                part_start += len(part)
+                if not all(part_files):
+                    failed_parts += 1
+                    continue
+                if len(part) > 1:
+                    telegram_responses = await self.send_album_to_telegram(list(zip(part, part_files)), caption, project, reply_to_message_id)
+                else:
+                    telegram_responses = [await self.send_file_to_telegram(part_files[0], caption, project, reply_to_message_id)]
+                caption = None
+                telegram_message_ids += [response.message_id for response in telegram_responses]
+        finally:
+            for local_file in local_files:
+                if local_file:
+                    utils.remove_downloaded_file(local_file)
+        if failed_parts:
+            logging.error(f"{failed_parts} of {len(parts)} file groups could not be downloaded from Slack")
+        return telegram_message_ids
+
+    async def send_album_to_telegram(self, album, caption, project, reply_to_message_id):
+        opened_files = []
+        try:
+            media = []
+            for file, local_file in album:
+                f = open(local_file, 'rb')
+                opened_files.append(f)
+                media.append(ALBUM_MIMETYPES[file['mimetype']](f, caption=caption if not media else None))
+
+            async def send():
+                # A retried album is read from the beginning of its files
+                for f in opened_files:
+                    f.seek(0)
+                return await self.bot.send_media_group(
+                    project['telegram_chat_id'], media, reply_to_message_id=reply_to_message_id
+                )
+
+            return await self.limiter.call(telegram_keys(project), send)
+        finally:
+            for f in opened_files:
+                f.close()
+
+    async def send_file_to_telegram(self, local_file, caption, project, reply_to_message_id):
+        with open(local_file, 'rb') as f:
+            async def send():
+                f.seek(0)
+                return await self.bot.send_document(
+                    project['telegram_chat_id'], f, caption=caption, reply_to_message_id=reply_to_message_id
+                )
+
+            return await self.limiter.call(telegram_keys(project), send)
+
+    async def download_slack_file(self, file_url, slack_token):
+        headers = {'Authorization': f'Bearer {slack_token}'}
+        local_filepath = os.path.join(tempfile.mkdtemp(prefix='slack-file-'), file_url.split("/")[-1])
+        try:
+            async with self.media_slots:
+                with metrics.stage_seconds.time(stage='media_download'):
+                    async with self.http.get(file_url, headers=headers) as response:
+                        if response.status != 200:
+                            logging.error(f"Error uploading file from Slack: {file_url}, status: {response.status}")
+                            utils.remove_downloaded_file(local_filepath)
+                            return None
+                        size = 0
+                        with open(local_filepath, 'wb') as f:
+                            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                                size += len(chunk)
+                                if size > self.media_max_size:
+                                    raise MediaTooLarge(f"File exceeds the limit of {self.media_max_size} bytes")
+                                f.write(chunk)
+            return local_filepath
+        except Exception as e:
+            logging.error(f"Error uploading file from Slack: {str(e)}")
+            shutil.rmtree(os.path.dirname(local_filepath), ignore_errors=True)
+            return None
+
+    async def on_telegram_message(self, message):
+        with metrics.stage_seconds.time(stage='ingest'):
+            self.spawn(('telegram', message.chat.id), self.handle_telegram_message(message))
+
+    async def on_telegram_message_edit(self, message):
+        project = utils.find_project_by_chat_id(message.chat.id)
+        if project:
+            target = (project['project_name'], 'telegram', message.message_id)
+            self.submit_edit(target, ('telegram', message.chat.id), self.handle_telegram_message_edit, message)
+
+    async def handle_telegram_message(self, message):
+        project = utils.find_project_by_chat_id(message.chat.id)
+        if not project or not project['active']:
+            return
+
+        slack_client = self.get_slack_client(project['slack_bot_token'])
+        sender_name = message.from_user.full_name if message.from_user else "Unknown"
+        telegram_username = f"@{message.from_user.username}" if message.from_user and message.from_user.username else ""
+        thread_ts = await asyncio.to_thread(utils.process_reply_message, message, project)
+
+        try:
+            if message.content_type == 'text':
+                slack_response = await self.limiter.call(
+                    slack_keys(project, 'post'), slack_client.chat_postMessage,
+                    channel=project['slack_channel_id'],
+                    text=f"{sender_name} \n{telegram_username}\n\n{message.text}",
+                    thread_ts=thread_ts
+                )
+                utils.save_thread_ts(message.message_id, slack_response['ts'], project['project_name'])
+            elif message.content_type in MEDIA_CONTENT_TYPES:
+                if not await self.send_media_to_slack(message, slack_client, project, sender_name, telegram_username, thread_ts):
+                    return
+            else:
+                return
+            metrics.messages_bridged.inc(project=project['project_name'], direction='telegram_to_slack', content_type=message.content_type)
+        except Exception as e:
+            logging.error(f"Error when processing a message from Telegram: {str(e)}")
+
+    # Returns True if the file was sent to Slack
+    async def send_media_to_slack(self, message, slack_client, project, sender_name, telegram_username, thread_ts):
+        media = message.photo[-1] if message.content_type == 'photo' else getattr(message, message.content_type)
+        file_info = await self.bot.get_file(media.file_id)
+        if file_info.file_size and file_info.file_size > self.media_max_size:
+            logging.error(f"File {file_info.file_path} is too large to forward: {file_info.file_size} bytes")
+            return False
+
+        file_url = asyncio_helper.FILE_URL.format(self.telegram_token, file_info.file_path)
+        async with self.media_slots:
+            try:
+                spool, size = await self.download_to_spool(file_url)
+            except MediaTooLarge as e:
+                logging.error(f"File {file_info.file_path} is too large to forward: {str(e)}")
+                return False
+            if spool is None:
+                return False
+            with spool:
+                file_id = await self.upload_spool_to_slack(
+                    slack_client, project, spool, size,
+                    filename=file_info.file_path.split('/')[-1],
+                    title=message.caption or "Media from Telegram",
+                    initial_comment=f"{sender_name} \n{telegram_username}",
+                    thread_ts=thread_ts
+                )
+        utils.save_thread_ts(message.message_id, file_id, project['project_name'])
+        return True
+
+    # Kept in memory up to media_memory_limit, written to disk in chunks above it
+    async def download_to_spool(self, file_url):
+        with metrics.stage_seconds.time(stage='media_download'):
+            async with self.http.get(file_url) as response:
+                if response.status != 200:
+                    logging.error(f"Error downloading file from Telegram: status {response.status}, URL: {file_url}")
+                    return None, 0
+                if (response.content_length or 0) > self.media_max_size:
+                    raise MediaTooLarge(f"File size {response.content_length} exceeds the limit of {self.media_max_size} bytes")
+
+                spool = tempfile.SpooledTemporaryFile(max_size=self.media_memory_limit)
+                size = 0
+                try:
+                    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                        size += len(chunk)
+                        if size > self.media_max_size:
+                            raise MediaTooLarge(f"File exceeds the limit of {self.media_max_size} bytes")
+                        spool.write(chunk)
+                except Exception:
+                    spool.close()
+                    raise
+        spool.seek(0)
+        return spool, size
+
+    # Small files go through files_upload_v2 from memory, large ones are streamed from
+    # the temporary file to the external upload URL, as media.upload_spool_to_slack does
+    async def upload_spool_to_slack(self, slack_client, project, spool, size, filename, title, initial_comment, thread_ts):
+        keys = slack_keys(project, 'files')
+        if size <= self.media_memory_limit:
+            slack_response = await self.limiter.call(
+                keys, slack_client.files_upload_v2,
+                channel=project['slack_channel_id'],
+                file=spool.read(),
+                filename=filename,
+                title=title,
+                initial_comment=initial_comment,
+                thread_ts=thread_ts
+            )
+            return slack_response['file']['id']
+
+        upload = await self.limiter.call(keys, slack_client.files_getUploadURLExternal, filename=filename, length=size)
+
+        async def read_chunks():
+            while chunk := spool.read(CHUNK_SIZE):
+                yield chunk
+
+        async with self.http.post(upload['upload_url'], data=read_chunks(), headers={'Content-Length': str(size)}) as response:
+            response.raise_for_status()
+        await self.limiter.call(
+            keys, slack_client.files_completeUploadExternal,
+            files=[{'id': upload['file_id'], 'title': title}],
+            channel_id=project['slack_channel_id'],
+            initial_comment=initial_comment,
+            thread_ts=thread_ts
+        )
+        logging.debug(f"File {filename} ({size} bytes) streamed to Slack from a temporary file")
+        return upload['file_id']
+
+    async def handle_telegram_message_edit(self, message):
+        project = utils.find_project_by_chat_id(message.chat.id)
+        if not project or not project['active']:
+            return
+
+        slack_ts = await asyncio.to_thread(utils.get_thread_ts_from_slack, message.message_id, project['project_name'])
+        if not slack_ts:
+            logging.warning(f"Slack thread_ts not found for Telegram message {message.message_id}")
+            return
+        if message.content_type == 'text':
+            text = message.text
+        else:
+            # A caption edit replaces the text of the Slack file message
+            sender_name = message.from_user.full_name if message.from_user else "Unknown"
+            telegram_username = f"@{message.from_user.username}" if message.from_user and message.from_user.username else ""
+            text = f"{sender_name} \n{telegram_username}\n\n{message.caption or ''}"
+        target = (project['project_name'], 'telegram', message.message_id)
+        if self.edit_coalescer.is_unchanged(target, text):
+            return
+        try:
+            await self.limiter.call(
+                slack_keys(project, 'update'), self.get_slack_client(project['slack_bot_token']).chat_update,
+                channel=project['slack_channel_id'],
+                ts=slack_ts,
+                text=text
+            )
+            self.edit_coalescer.remember(target, text)
+        except Exception as e:
+            logging.error(f"Error when editing Slack message: {str(e)}")
+
+    # Remove the webhook and set webhook_url if given. Telegram errors are retried,
+    # so a failure at startup does not end the process.
+    async def setup_telegram_webhook(self, webhook_url, retry_delay=5):
+        while True:
+            try:
+                await self.bot.remove_webhook()
+                if webhook_url:
+                    await self.bot.set_webhook(url=webhook_url, secret_token=self.settings['telegram_webhook_secret'])
+                    logging.info(f"Telegram webhook set to {webhook_url}")
+                return
+            except Exception as e:
+                logging.error(f"Error setting up the Telegram webhook, retrying in {retry_delay}s: {str(e)}")
+                await asyncio.sleep(retry_delay)
+
+    async def run(self, host='0.0.0.0', port=5555):
+        self.loop = asyncio.get_running_loop()
+        self.edit_coalescer.start()
+        self.event_deduper = EventDeduper(
+            utils.DB_PATH, utils.mapping_store.writer, window=self.settings.get('dedupe_window', 10000)
+        )
+        self.http = ClientSession(connector=TCPConnector(limit=self.settings.get('async_http_connections', 100)))
+        app = web.Application()
+        app.router.add_post('/slack/events', self.slack_event_handler)
+        app.router.add_post('/telegram/webhook', self.telegram_webhook_handler)
+        app.router.add_get('/metrics', self.metrics_handler)
+        metrics.in_flight.set_function(lambda: len(self.tasks), kind='tasks')
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        logging.info(f"Asyncio gate is listening on {host}:{port}")
+        await self.sync_socket_mode(utils.current_routes.config)
+        utils.config_listeners.append(
+            lambda config: asyncio.run_coroutine_threadsafe(self.sync_socket_mode(config), self.loop)
+        )
+        try:
+            if utils.get_telegram_mode(self.settings) == 'webhook':
+                await self.setup_telegram_webhook(self.settings['telegram_webhook_url'])
+                await asyncio.Event().wait()
+            else:
+                # Without the webhook of an earlier run in webhook mode, getUpdates does not fail with 409
+                await self.setup_telegram_webhook(None)
+                await self.bot.infinity_polling(timeout=self.settings.get('telegram_polling_timeout', 20))
+        finally:
+            await runner.cleanup()
+            await self.http.close()
+
+def run(config, host='0.0.0.0', port=5555):
+    utils.get_telegram_mode(config['settings'])
+    utils.init_storage(config['settings'].get('database_per_project', False))
+    utils.init_retention(config['settings'])
+    utils.start_config_monitor(interval=60)
+    asyncio.run(AsyncBridge(config).run(host, port))
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        filename='integration.log',
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+    run(utils.load_config(check_tokens=False))
@@ -0,0 +1,14 @@
+#!/bin/sh
+# Short run of every scenario with both runtimes and both Slack ingestion modes,
+# fails if a message is lost or a request to the gate fails.
+#
+#   sh bench/check.sh
+set -e
+cd "$(dirname "$0")/.."
+
+for runtime in threads asyncio; do
+    for ingestion in http socket; do
+        echo "== runtime $runtime, ingestion $ingestion"
+        python bench/run.py --runtime "$runtime" --ingestion "$ingestion" --count 20 --projects 2 --timeout 30 --check "$@"
+    done
+done
@@ -0,0 +1,298 @@
+import re
+import json
+import time
+import random
+import threading
+import email.parser
+import email.policy
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Local stand-ins for the Telegram Bot API and the Slack Web API. They answer the
+# methods used by the gate with plausible payloads, can add latency and answer 429
+# above a request rate, and report the first time each benchmark marker reaches them.
+
+MARKER_PATTERN = re.compile(r'bench-[a-z_]+-\d+')
+
+class RateLimit:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Seconds until the next request is allowed, 0 if this request is allowed
+    def take(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+def parse_params(handler, body):
+    params = {key: values[-1] for key, values in parse_qs(urlparse(handler.path).query).items()}
+    content_type = handler.headers.get('Content-Type', '')
+    if content_type.startswith('application/json') and body:
+        params.update(json.loads(body))
+    elif content_type.startswith('application/x-www-form-urlencoded') and body:
+        params.update({key: values[-1] for key, values in parse_qs(body.decode('utf-8')).items()})
+    elif content_type.startswith('multipart/form-data'):
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            b'Content-Type: ' + content_type.encode('utf-8') + b'\r\n\r\n' + body
+        )
+        for part in message.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+            if part.get_filename():
+                params[name] = {'filename': part.get_filename(), 'size': len(part.get_payload(decode=True) or b'')}
+            else:
+                params[name] = part.get_payload(decode=True).decode('utf-8')
+    return params
+
+class FakeApiServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Methods whose arrival means a message was bridged
+    delivery_methods = ()
+
+    def __init__(self, port=0, latency=0.0, jitter=0.0, rate_limit=0, on_marker=None):
+        super().__init__(('127.0.0.1', port), self.handler_class)
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = RateLimit(rate_limit) if rate_limit else None
+        self.on_marker = on_marker
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.rate_limited = 0
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name=type(self).__name__, daemon=True).start()
+        return self
+
+    def count(self, method):
+        with self.lock:
+            self.requests[method] = self.requests.get(method, 0) + 1
+
+    def delay(self):
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+
+    # Seconds the client must wait, or 0 if the request may proceed
+    def check_rate_limit(self):
+        retry_after = self.rate_limit.take() if self.rate_limit else 0
+        if retry_after:
+            with self.lock:
+                self.rate_limited += 1
+        return retry_after
+
+    def report(self, method, *texts):
+        if self.on_marker and method in self.delivery_methods:
+            received = time.monotonic()
+            for text in texts:
+                for marker in MARKER_PATTERN.findall(str(text)):
+                    self.on_marker(marker, received, method)
+
+class BaseHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def send_json(self, payload, status=200, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_bytes(self, body, content_type='application/octet-stream'):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Telegram clients also send GET requests with a form body (e.g. deleteWebhook), the
+    # body must be read or it is parsed as the next request of the keep-alive connection
+    def do_GET(self):
+        self.handle_request(self.read_body())
+
+    def do_POST(self):
+        self.handle_request(self.read_body())
+
+# Telegram Bot API: /bot<token>/<method> and /file/bot<token>/<path>
+class TelegramHandler(BaseHandler):
+    def handle_request(self, body):
+        path = urlparse(self.path).path
+        if path.startswith('/file/'):
+            self.server.count('file')
+            self.server.delay()
+            return self.send_bytes(b'\0' * self.server.file_size)
+
+        method = path.rsplit('/', 1)[-1]
+        params = parse_params(self, body)
+        self.server.count(method)
+        self.server.delay()
+        retry_after = self.server.check_rate_limit()
+        if retry_after:
+            retry_after = max(1, round(retry_after))
+            return self.send_json({
+                'ok': False, 'error_code': 429,
+                'description': f'Too Many Requests: retry after {retry_after}',
+                'parameters': {'retry_after': retry_after},
+            }, status=429)
+
+        result = self.server.call(method, params)
+        self.send_json({'ok': True, 'result': result})
+
+class FakeTelegramServer(FakeApiServer):
+    handler_class = TelegramHandler
+    delivery_methods = ('sendMessage', 'sendDocument', 'sendPhoto', 'sendVideo', 'sendMediaGroup', 'editMessageText', 'editMessageCaption')
+
+    def __init__(self, *args, file_size=64 * 1024, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.file_size = file_size
+        self.message_ids = iter(range(1, 1 << 62))
+        self.sent = {}   # marker -> message_id of the message that carried it
+
+    def message(self, params, **fields):
+        with self.lock:
+            message_id = next(self.message_ids)
+        chat_id = params.get('chat_id', 0)
+        message = {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': int(chat_id) if str(chat_id).lstrip('-').isdigit() else 0, 'type': 'supergroup'},
+            'from': {'id': 1, 'is_bot': True, 'first_name': 'Gate'},
+        }
+        message.update(fields)
+        for marker in MARKER_PATTERN.findall(json.dumps(fields)):
+            self.sent.setdefault(marker, message_id)
+        return message
+
+    def call(self, method, params):
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Gate', 'username': 'gate_bot'}
+        if method in ('setWebhook', 'deleteWebhook'):
+            return True
+        if method == 'getUpdates':
+            time.sleep(1)
+            return []
+        if method == 'getFile':
+            file_id = params.get('file_id', 'file')
+            return {'file_id': file_id, 'file_unique_id': file_id, 'file_size': self.file_size, 'file_path': f'documents/{file_id}.bin'}
+
+        self.report(method, params.get('text'), params.get('caption'), params.get('media'))
+        if method == 'sendMessage':
+            return self.message(params, text=params.get('text', ''))
+        if method in ('sendDocument', 'sendPhoto', 'sendVideo'):
+            document = {'file_id': 'doc', 'file_unique_id': 'doc'}
+            return self.message(params, document=document, caption=params.get('caption', ''))
+        if method == 'sendMediaGroup':
+            media = json.loads(params.get('media') or '[]')
+            return [self.message(params, photo=[{'file_id': 'photo', 'file_unique_id': 'photo', 'width': 1, 'height': 1}], caption=item.get('caption') or '')
+                    for item in media]
+        if method in ('editMessageText', 'editMessageCaption'):
+            return self.message(params, text=params.get('text') or params.get('caption') or '', edit_date=int(time.time()))
+        return True
+
+# Slack Web API: /api/<method>, file downloads at /files/<id>/<name>, external uploads at /upload/<id>
+class SlackHandler(BaseHandler):
+    def handle_request(self, body):
+        path = urlparse(self.path).path
+        if path.startswith('/files/'):
+            self.server.count('file')
+            self.server.delay()
+            return self.send_bytes(b'\0' * self.server.file_size)
+        if path.startswith('/upload/'):
+            self.server.count('upload')
+            self.server.delay()
+            return self.send_bytes(b'OK', 'text/plain')
+
+        method = path.rsplit('/', 1)[-1]
+        params = parse_params(self, body)
+        self.server.count(method)
+        self.server.delay()
+        retry_after = self.server.check_rate_limit()
+        if retry_after:
+            return self.send_json({'ok': False, 'error': 'ratelimited'}, status=429, headers={'Retry-After': str(max(1, round(retry_after)))})
+
+        result = {'ok': True}
+        result.update(self.server.call(method, params))
+        self.send_json(result)
+
+class FakeSlackServer(FakeApiServer):
+    handler_class = SlackHandler
+    delivery_methods = ('chat.postMessage', 'chat.update', 'files.completeUploadExternal')
+
+    def __init__(self, *args, file_size=64 * 1024, bot_user_id='UBENCHBOT', users=100, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.file_size = file_size
+        self.bot_user_id = bot_user_id
+        self.users = [f'U{i:08d}' for i in range(users)]
+        self.file_ids = iter(range(1, 1 << 62))
+        self.uploads = {}   # file id -> file name
+        self.ts = 1700000000.0
+        self.sent = {}   # marker -> ts of the message that carried it
+        self.socket_url = None   # URL of FakeSocketModeServer for apps.connections.open
+
+    def next_ts(self):
+        with self.lock:
+            self.ts += 0.000001
+            return f'{self.ts:.6f}'
+
+    def user(self, user_id):
+        return {'id': user_id, 'name': user_id.lower(), 'real_name': f'User {user_id}', 'profile': {'display_name': f'user_{user_id}'}}
+
+    def call(self, method, params):
+        if method == 'auth.test':
+            return {'user_id': self.bot_user_id, 'team_id': 'TBENCH', 'user': 'gate'}
+        if method == 'users.info':
+            return {'user': self.user(params.get('user', 'U0'))}
+        if method == 'users.list':
+            cursor = int(params.get('cursor') or 0)
+            limit = int(params.get('limit') or 200)
+            members = [self.user(user_id) for user_id in self.users[cursor:cursor + limit]]
+            next_cursor = str(cursor + limit) if cursor + limit < len(self.users) else ''
+            return {'members': members, 'response_metadata': {'next_cursor': next_cursor}}
+        if method == 'chat.postMessage':
+            self.report(method, params.get('text'))
+            ts = self.next_ts()
+            for marker in MARKER_PATTERN.findall(str(params.get('text'))):
+                self.sent.setdefault(marker, ts)
+            return {'channel': params.get('channel'), 'ts': ts, 'message': {'text': params.get('text'), 'ts': ts}}
+        if method == 'chat.update':
+            self.report(method, params.get('text'))
+            return {'channel': params.get('channel'), 'ts': params.get('ts'), 'text': params.get('text')}
+        if method == 'files.getUploadURLExternal':
+            file_id = f'F{next(self.file_ids):010d}'
+            with self.lock:
+                self.uploads[file_id] = params.get('filename', '')
+            return {'upload_url': f'{self.url}/upload/{file_id}', 'file_id': file_id}
+        if method == 'files.completeUploadExternal':
+            files = params.get('files') or '[]'
+            files = json.loads(files) if isinstance(files, str) else files
+            with self.lock:
+                names = [self.uploads.get(file['id'], '') for file in files]
+            self.report(method, params.get('initial_comment'), *names)
+            return {'files': [{'id': file['id'], 'title': file.get('title'), 'name': name} for file, name in zip(files, names)]}
+        if method == 'apps.connections.open':
+            if not self.socket_url:
+                return {'ok': False, 'error': 'not_allowed_token_type'}
+            return {'url': self.socket_url}
+        if method == 'files.info':
+            return {'file': {'id': params.get('file'), 'name': self.uploads.get(params.get('file'), '')}}
+        return {}
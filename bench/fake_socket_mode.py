@@ -0,0 +1,174 @@
+import json
+import time
+import uuid
+import base64
+import struct
+import hashlib
+import threading
+import socketserver
+
+# Local stand-in for the Slack Socket Mode websocket (RFC 6455, no extensions).
+# FakeSlackServer answers apps.connections.open with the URL of this server; events
+# pushed with send_event() go out as events_api envelopes to the connected clients in
+# turn, and the time of each acknowledgement is recorded.
+
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+OPCODE_CONTINUATION = 0x0
+OPCODE_TEXT = 0x1
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xA
+
+def encode_frame(opcode, payload):
+    header = bytes([0x80 | opcode])
+    length = len(payload)
+    if length < 126:
+        header += bytes([length])
+    elif length < 1 << 16:
+        header += bytes([126]) + struct.pack('!H', length)
+    else:
+        header += bytes([127]) + struct.pack('!Q', length)
+    return header + payload
+
+def read_exact(rfile, size):
+    data = rfile.read(size)
+    if len(data) < size:
+        raise ConnectionError('Connection closed')
+    return data
+
+# Returns (fin, opcode, payload) of the next frame, unmasking client frames
+def read_frame(rfile):
+    first, second = read_exact(rfile, 2)
+    length = second & 0x7F
+    if length == 126:
+        length = struct.unpack('!H', read_exact(rfile, 2))[0]
+    elif length == 127:
+        length = struct.unpack('!Q', read_exact(rfile, 8))[0]
+    mask = read_exact(rfile, 4) if second & 0x80 else None
+    payload = read_exact(rfile, length)
+    if mask:
+        payload = bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload))
+    return bool(first & 0x80), first & 0x0F, payload
+
+class SocketModeConnection(socketserver.StreamRequestHandler):
+    def handle(self):
+        if not self.handshake():
+            return
+        self.send_lock = threading.Lock()
+        self.send_text({'type': 'hello', 'num_connections': 1, 'connection_info': {'app_id': 'ABENCH'}, 'debug_info': {'host': 'bench'}})
+        self.server.add_connection(self)
+        try:
+            self.receive()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.server.remove_connection(self)
+
+    def handshake(self):
+        headers = {}
+        request_line = self.rfile.readline()
+        while True:
+            line = self.rfile.readline().decode('latin-1').strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        key = headers.get('sec-websocket-key')
+        if not request_line or not key:
+            self.wfile.write(b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n\r\n')
+            return False
+        accept = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode('ascii')).digest()).decode('ascii')
+        self.wfile.write(
+            'HTTP/1.1 101 Switching Protocols\r\n'
+            'Upgrade: websocket\r\n'
+            'Connection: Upgrade\r\n'
+            f'Sec-WebSocket-Accept: {accept}\r\n\r\n'.encode('ascii')
+        )
+        return True
+
+    def send_frame(self, opcode, payload):
+        with self.send_lock:
+            self.wfile.write(encode_frame(opcode, payload))
+            self.wfile.flush()
+
+    def send_text(self, message):
+        self.send_frame(OPCODE_TEXT, json.dumps(message).encode('utf-8'))
+
+    def receive(self):
+        message = b''
+        while True:
+            fin, opcode, payload = read_frame(self.rfile)
+            if opcode == OPCODE_PING:
+                self.send_frame(OPCODE_PONG, payload)
+            elif opcode == OPCODE_CLOSE:
+                self.send_frame(OPCODE_CLOSE, payload[:2])
+                return
+            elif opcode in (OPCODE_TEXT, OPCODE_CONTINUATION):
+                message += payload
+                if fin:
+                    self.server.on_message(json.loads(message))
+                    message = b''
+
+class FakeSocketModeServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0):
+        super().__init__(('127.0.0.1', port), SocketModeConnection)
+        self.cond = threading.Condition()
+        self.connections = []
+        self.next_connection = 0
+        self.envelopes = {}   # envelope id -> send time
+        self.acks = {}        # envelope id -> acknowledgement delay in seconds
+
+    @property
+    def url(self):
+        return f'ws://127.0.0.1:{self.server_address[1]}/link'
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name='fake-socket-mode', daemon=True).start()
+        return self
+
+    def add_connection(self, connection):
+        with self.cond:
+            self.connections.append(connection)
+            self.cond.notify_all()
+
+    def remove_connection(self, connection):
+        with self.cond:
+            if connection in self.connections:
+                self.connections.remove(connection)
+
+    def wait_for_connection(self, timeout):
+        with self.cond:
+            return self.cond.wait_for(lambda: self.connections, timeout)
+
+    def on_message(self, message):
+        envelope_id = message.get('envelope_id')
+        with self.cond:
+            if envelope_id in self.envelopes and envelope_id not in self.acks:
+                self.acks[envelope_id] = time.monotonic() - self.envelopes[envelope_id]
+
+    # Push an Events API body (type event_callback) as an envelope, False without clients
+    def send_event(self, body):
+        envelope_id = str(uuid.uuid4())
+        with self.cond:
+            if not self.connections:
+                return False
+            connection = self.connections[self.next_connection % len(self.connections)]
+            self.next_connection += 1
+            self.envelopes[envelope_id] = time.monotonic()
+        connection.send_text({
+            'envelope_id': envelope_id,
+            'type': 'events_api',
+            'accepts_response_payload': False,
+            'retry_attempt': 0,
+            'retry_reason': '',
+            'payload': body,
+        })
+        return True
+
+    def ack_delays(self):
+        with self.cond:
+            return sorted(self.acks.values())
@@ -0,0 +1,124 @@
+import os
+import sys
+import json
+import time
+import urllib.request
+import urllib.error
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from signing import slack_signature
+
+# Load generator: signed Slack Events API requests to /slack/events and Telegram
+# updates to /telegram/webhook, built the way Slack and Telegram send them.
+
+def post(url, body, headers, timeout=30):
+    request = urllib.request.Request(url, data=body, headers=headers, method='POST')
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+class SlackEventSender:
+    def __init__(self, url, signing_secret=None):
+        self.url = url
+        self.signing_secret = signing_secret
+        self.event_ids = iter(range(1, 1 << 62))
+
+    def send(self, event, event_id=None):
+        body = json.dumps(event_callback(event, event_id or f'Ev{next(self.event_ids):010d}')).encode('utf-8')
+        headers = {'Content-Type': 'application/json'}
+        if self.signing_secret:
+            timestamp = str(int(time.time()))
+            headers['X-Slack-Request-Timestamp'] = timestamp
+            headers['X-Slack-Signature'] = slack_signature(self.signing_secret, timestamp, body)
+        return post(self.url, body, headers)
+
+# Events pushed over the Socket Mode stand-in (fake_socket_mode.py) instead of HTTP
+class SocketModeEventSender:
+    def __init__(self, server):
+        self.server = server
+        self.event_ids = iter(range(1, 1 << 62))
+
+    def send(self, event, event_id=None):
+        body = event_callback(event, event_id or f'Ev{next(self.event_ids):010d}')
+        return 200 if self.server.send_event(body) else 503
+
+def event_callback(event, event_id):
+    return {
+        'type': 'event_callback',
+        'team_id': 'TBENCH',
+        'event_id': event_id,
+        'event_time': int(time.time()),
+        'event': event,
+    }
+
+class TelegramUpdateSender:
+    def __init__(self, url, secret_token=None):
+        self.url = url
+        self.secret_token = secret_token
+        self.update_ids = iter(range(1, 1 << 62))
+
+    def send(self, update):
+        update = dict(update, update_id=next(self.update_ids))
+        headers = {'Content-Type': 'application/json'}
+        if self.secret_token:
+            headers['X-Telegram-Bot-Api-Secret-Token'] = self.secret_token
+        return post(self.url, json.dumps(update).encode('utf-8'), headers)
+
+# Slack events
+
+def slack_message(channel, user, text, ts, thread_ts=None):
+    event = {'type': 'message', 'channel': channel, 'user': user, 'text': text, 'ts': ts, 'event_ts': ts, 'channel_type': 'channel'}
+    if thread_ts:
+        event['thread_ts'] = thread_ts
+    return event
+
+def slack_message_changed(channel, user, text, ts, edit_ts):
+    return {
+        'type': 'message', 'subtype': 'message_changed', 'channel': channel, 'ts': edit_ts, 'event_ts': edit_ts,
+        'message': {'type': 'message', 'user': user, 'text': text, 'ts': ts, 'edited': {'user': user, 'ts': edit_ts}},
+        'previous_message': {'type': 'message', 'user': user, 'text': '', 'ts': ts},
+    }
+
+def slack_file_message(channel, user, text, ts, file_url, file_id, name='report.bin', mimetype='application/octet-stream'):
+    event = slack_message(channel, user, text, ts)
+    event['files'] = [{
+        'id': file_id, 'name': name, 'mimetype': mimetype,
+        'url_private': f'{file_url}/{file_id}/{name}', 'url_private_download': f'{file_url}/{file_id}/{name}',
+    }]
+    return event
+
+# Telegram updates
+
+def telegram_user(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': 'Bench', 'last_name': str(user_id), 'username': f'bench{user_id}'}
+
+def telegram_message(chat_id, message_id, user_id, text=None, reply_to_message_id=None, **fields):
+    message = {
+        'message_id': message_id,
+        'date': int(time.time()),
+        'chat': {'id': int(chat_id), 'type': 'supergroup', 'title': 'Bench'},
+        'from': telegram_user(user_id),
+    }
+    if text is not None:
+        message['text'] = text
+    if reply_to_message_id:
+        message['reply_to_message'] = {
+            'message_id': reply_to_message_id, 'date': int(time.time()),
+            'chat': message['chat'], 'from': telegram_user(1), 'text': '',
+        }
+    message.update(fields)
+    return {'message': message}
+
+def telegram_edited_message(chat_id, message_id, user_id, text):
+    update = telegram_message(chat_id, message_id, user_id, text)
+    update['message']['edit_date'] = int(time.time())
+    return {'edited_message': update['message']}
+
+def telegram_document(chat_id, message_id, user_id, file_id, file_size):
+    return telegram_message(chat_id, message_id, user_id, document={
+        'file_id': file_id, 'file_unique_id': file_id, 'file_name': f'{file_id}.bin',
+        'mime_type': 'application/octet-stream', 'file_size': file_size,
+    })
@@ -0,0 +1,440 @@
+import os
+import sys
+import json
+import time
+import signal
+import shutil
+import sqlite3
+import argparse
+import tempfile
+import threading
+import subprocess
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from fake_apis import FakeTelegramServer, FakeSlackServer
+from fake_socket_mode import FakeSocketModeServer
+import loadgen
+
+# End-to-end benchmark of the gate, fully offline. Starts the fake Telegram and Slack
+# APIs, runs main.py against them in a temporary directory and reports throughput,
+# bridge latency, memory and mapping database growth for each scenario.
+#
+#   python bench/run.py --scenarios text,reply,edit,media --count 500
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ['text', 'reply', 'edit', 'media']
+SIGNING_SECRET = 'benchsigningsecret'
+WEBHOOK_SECRET = 'benchwebhooksecret'
+
+# Send and arrival times of the markers carried by bridged messages
+class Tracker:
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.sent = {}
+        self.delivered = {}
+
+    def mark_sent(self, marker):
+        with self.lock:
+            self.sent[marker] = time.monotonic()
+
+    def on_marker(self, marker, received, method):
+        with self.lock:
+            self.delivered.setdefault(marker, received)
+            self.lock.notify_all()
+
+    def wait(self, markers, timeout):
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while not all(marker in self.delivered for marker in markers):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.lock.wait(remaining)
+        return True
+
+    def latencies(self, markers):
+        with self.lock:
+            return sorted(self.delivered[marker] - self.sent[marker] for marker in markers if marker in self.delivered)
+
+def percentile(values, p):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+# Resident memory of the gate and its gunicorn workers, in bytes
+def process_tree_rss(root_pid):
+    children = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+                children.setdefault(ppid, []).append(int(entry))
+            except (OSError, ValueError, IndexError):
+                pass
+    total, stack = 0, [root_pid]
+    while stack:
+        pid = stack.pop()
+        stack.extend(children.get(pid, []))
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return total
+
+class MemorySampler:
+    def __init__(self, pid, interval=0.5):
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+        return self
+
+    def _run(self):
+        while not self.stopped.is_set():
+            if os.path.isdir('/proc'):
+                self.peak = max(self.peak, process_tree_rss(self.pid))
+            self.stopped.wait(self.interval)
+
+    def reset(self):
+        self.peak = process_tree_rss(self.pid) if os.path.isdir('/proc') else 0
+
+def db_size(workdir):
+    return sum(os.path.getsize(os.path.join(workdir, name)) for name in ('messages.db', 'messages.db-wal')
+               if os.path.exists(os.path.join(workdir, name)))
+
+def db_rows(workdir):
+    path = os.path.join(workdir, 'messages.db')
+    if not os.path.exists(path):
+        return 0
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    try:
+        return conn.execute('SELECT COUNT(*) FROM message_threads').fetchone()[0]
+    except sqlite3.Error:
+        return 0
+    finally:
+        conn.close()
+
+def write_config(workdir, args, telegram, slack):
+    settings = {
+        'telegram_bot_gate_token': '123456:bench',
+        'telegram_api_url': telegram.url,
+        'slack_api_url': f'{slack.url}/api/',
+        'telegram_mode': 'webhook',
+        'telegram_webhook_url': f'{args.gate_url}/telegram/webhook',
+        'telegram_webhook_secret': WEBHOOK_SECRET,
+        'slack_signing_secret': SIGNING_SECRET,
+        'public_url': args.gate_url,
+        'discover_public_ip': False,
+        'coordinator_socket': os.path.join(workdir, 'gate.sock'),
+    }
+    if args.runtime == 'asyncio':
+        settings['runtime'] = 'asyncio'
+    if not args.gate_rate_limits:
+        # Measure the gate, not its client-side throttling
+        settings['rate_limits'] = {name: [100000, 100000] for name in ('telegram', 'telegram_chat', 'slack_post', 'slack_update', 'slack_files')}
+    channels = [{
+        'project_name': f'bench_{i}',
+        'telegram_chat_id': str(-1000000000 - i),
+        'slack_channel_id': f'CBENCH{i:04d}',
+        'slack_bot_token': f'xoxb-bench-{i}',
+        'active': True,
+    } for i in range(args.projects)]
+    if args.ingestion == 'socket':
+        # One Slack app for all projects, so one Socket Mode connection
+        for project in channels:
+            project['slack_ingestion'] = 'socket'
+            project['slack_app_token'] = 'xapp-1-bench'
+    # JSON is valid YAML
+    with open(os.path.join(workdir, 'config.yaml'), 'w') as f:
+        json.dump({'settings': settings, 'channels': channels}, f, indent=2)
+    return channels
+
+def start_gate(workdir):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = REPO + os.pathsep + env.get('PYTHONPATH', '')
+    return subprocess.Popen(
+        [sys.executable, os.path.join(REPO, 'main.py')], cwd=workdir, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True
+    )
+
+def stop_gate(process):
+    try:
+        os.killpg(process.pid, signal.SIGINT)
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        pass
+    except ProcessLookupError:
+        return
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+def wait_until_ready(gate_url, process, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'The gate exited with code {process.returncode}, see integration.log')
+        try:
+            with urllib.request.urlopen(f'{gate_url}/metrics', timeout=2) as response:
+                if response.status == 200:
+                    return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f'The gate did not start in {timeout}s')
+
+class Bench:
+    def __init__(self, args, channels, telegram, slack, tracker, socket_mode=None):
+        self.args = args
+        self.channels = channels
+        self.telegram = telegram
+        self.slack = slack
+        self.tracker = tracker
+        if socket_mode:
+            self.slack_sender = loadgen.SocketModeEventSender(socket_mode)
+        else:
+            self.slack_sender = loadgen.SlackEventSender(f'{args.gate_url}/slack/events', SIGNING_SECRET)
+        self.telegram_sender = loadgen.TelegramUpdateSender(f'{args.gate_url}/telegram/webhook', WEBHOOK_SECRET)
+        self.pool = ThreadPoolExecutor(max_workers=args.concurrency)
+        self.counter = iter(range(1, 1 << 62))
+        self.errors = 0
+
+    def next_id(self):
+        return next(self.counter)
+
+    def slack_ts(self):
+        return f'{1800000000 + self.next_id()}.000100'
+
+    def user(self, i):
+        return self.slack.users[i % len(self.slack.users)]
+
+    # Send (marker, func) pairs at the configured rate, markers are timed from the send
+    def send_all(self, sends):
+        interval = 1 / self.args.rate if self.args.rate else 0
+        started = time.monotonic()
+        futures = []
+        for i, (marker, func) in enumerate(sends):
+            if interval:
+                time.sleep(max(0, started + i * interval - time.monotonic()))
+            futures.append(self.pool.submit(self._send, marker, func))
+        for future in futures:
+            future.result()
+
+    def _send(self, marker, func):
+        self.tracker.mark_sent(marker)
+        status = func()
+        if status != 200:
+            self.errors += 1
+
+    # Messages that later steps reply to or edit, bridged before timing starts
+    def seed(self, count):
+        slack_seeds, telegram_seeds = [], []
+        sends = []
+        for i in range(count):
+            project = self.channels[i % len(self.channels)]
+            marker = f'bench-seed-{self.next_id()}'
+            ts = self.slack_ts()
+            event = loadgen.slack_message(project['slack_channel_id'], self.user(i), marker, ts)
+            sends.append((marker, lambda event=event: self.slack_sender.send(event)))
+            slack_seeds.append((project, marker, ts))
+
+            marker = f'bench-seed-{self.next_id()}'
+            message_id = self.next_id()
+            update = loadgen.telegram_message(project['telegram_chat_id'], message_id, 1000 + i, marker)
+            sends.append((marker, lambda update=update: self.telegram_sender.send(update)))
+            telegram_seeds.append((project, marker, message_id))
+        self.send_all(sends)
+        if not self.tracker.wait([marker for marker, _ in sends], self.args.timeout):
+            raise RuntimeError('Seed messages were not bridged in time')
+        # Give the write-behind writer a moment so the mappings are on disk
+        time.sleep(0.2)
+        return slack_seeds, telegram_seeds
+
+    def scenario_text(self, count):
+        sends = []
+        for i in range(count):
+            project = self.channels[i % len(self.channels)]
+            marker = f'bench-text-{self.next_id()}'
+            if i % 2 == 0:
+                event = loadgen.slack_message(project['slack_channel_id'], self.user(i), marker, self.slack_ts())
+                sends.append((marker, lambda event=event: self.slack_sender.send(event)))
+            else:
+                update = loadgen.telegram_message(project['telegram_chat_id'], self.next_id(), 1000 + i, marker)
+                sends.append((marker, lambda update=update: self.telegram_sender.send(update)))
+        return sends
+
+    def scenario_reply(self, count):
+        slack_seeds, telegram_seeds = self.seed(max(1, min(count // 10, 50)))
+        sends = []
+        for i in range(count):
+            marker = f'bench-reply-{self.next_id()}'
+            if i % 2 == 0:
+                project, _, ts = slack_seeds[i % len(slack_seeds)]
+                event = loadgen.slack_message(project['slack_channel_id'], self.user(i), marker, self.slack_ts(), thread_ts=ts)
+                sends.append((marker, lambda event=event: self.slack_sender.send(event)))
+            else:
+                # A reply to the Telegram copy of a Slack message goes to its Slack thread
+                project, seed_marker, _ = slack_seeds[i % len(slack_seeds)]
+                reply_to = self.telegram.sent[seed_marker]
+                update = loadgen.telegram_message(project['telegram_chat_id'], self.next_id(), 1000 + i, marker, reply_to_message_id=reply_to)
+                sends.append((marker, lambda update=update: self.telegram_sender.send(update)))
+        return sends
+
+    def scenario_edit(self, count):
+        # Every edit has its own target message, so edits are never coalesced
+        slack_seeds, telegram_seeds = self.seed((count + 1) // 2)
+        sends = []
+        for i in range(count):
+            marker = f'bench-edit-{self.next_id()}'
+            if i % 2 == 0:
+                project, _, ts = slack_seeds[i // 2]
+                event = loadgen.slack_message_changed(project['slack_channel_id'], self.user(i), marker, ts, self.slack_ts())
+                sends.append((marker, lambda event=event: self.slack_sender.send(event)))
+            else:
+                project, _, message_id = telegram_seeds[i // 2]
+                update = loadgen.telegram_edited_message(project['telegram_chat_id'], message_id, 1000 + i, marker)
+                sends.append((marker, lambda update=update: self.telegram_sender.send(update)))
+        return sends
+
+    def scenario_media(self, count):
+        sends = []
+        for i in range(count):
+            project = self.channels[i % len(self.channels)]
+            marker = f'bench-media-{self.next_id()}'
+            if i % 2 == 0:
+                event = loadgen.slack_file_message(
+                    project['slack_channel_id'], self.user(i), marker, self.slack_ts(),
+                    f'{self.slack.url}/files', f'F{self.next_id():010d}'
+                )
+                sends.append((marker, lambda event=event: self.slack_sender.send(event)))
+            else:
+                # The file id becomes the file name of the Slack upload, which carries the marker
+                update = loadgen.telegram_document(project['telegram_chat_id'], self.next_id(), 1000 + i, marker, self.args.file_size)
+                sends.append((marker, lambda update=update: self.telegram_sender.send(update)))
+        return sends
+
+    def run_scenario(self, name, workdir, memory):
+        sends = getattr(self, f'scenario_{name}')(self.args.count)
+        markers = [marker for marker, _ in sends]
+        size_before, rows_before = db_size(workdir), db_rows(workdir)
+        memory.reset()
+        errors_before = self.errors
+        started = time.monotonic()
+
+        self.send_all(sends)
+        sent_duration = time.monotonic() - started
+        self.tracker.wait(markers, self.args.timeout)
+        latencies = self.tracker.latencies(markers)
+        finished = max([self.tracker.delivered[m] for m in markers if m in self.tracker.delivered], default=time.monotonic())
+        duration = max(finished - started, 1e-9)
+        time.sleep(0.2)
+
+        return {
+            'scenario': name,
+            'sent': len(markers),
+            'delivered': len(latencies),
+            'lost': len(markers) - len(latencies),
+            'http_errors': self.errors - errors_before,
+            'send_seconds': round(sent_duration, 3),
+            'duration_seconds': round(duration, 3),
+            'throughput_per_second': round(len(latencies) / duration, 1),
+            'latency_p50_ms': round(percentile(latencies, 50) * 1000, 1) if latencies else None,
+            'latency_p99_ms': round(percentile(latencies, 99) * 1000, 1) if latencies else None,
+            'latency_max_ms': round(latencies[-1] * 1000, 1) if latencies else None,
+            'rss_peak_mb': round(memory.peak / 1024 / 1024, 1),
+            'db_growth_kb': round((db_size(workdir) - size_before) / 1024, 1),
+            'db_rows_added': db_rows(workdir) - rows_before,
+        }
+
+def print_report(results, telegram, slack, socket_mode=None):
+    columns = ['scenario', 'sent', 'delivered', 'lost', 'throughput_per_second', 'latency_p50_ms', 'latency_p99_ms',
+               'latency_max_ms', 'rss_peak_mb', 'db_growth_kb', 'db_rows_added']
+    widths = [max(len(column), *(len(str(result[column])) for result in results)) for column in columns]
+    print('  '.join(column.ljust(width) for column, width in zip(columns, widths)))
+    for result in results:
+        print('  '.join(str(result[column]).ljust(width) for column, width in zip(columns, widths)))
+    print(f'Telegram API requests: {dict(sorted(telegram.requests.items()))}, answered with 429: {telegram.rate_limited}')
+    print(f'Slack API requests: {dict(sorted(slack.requests.items()))}, answered with 429: {slack.rate_limited}')
+    if socket_mode:
+        acks = socket_mode.ack_delays()
+        if acks:
+            print(f'Socket Mode acks: {len(acks)}, p50 {percentile(acks, 50) * 1000:.1f} ms, p99 {percentile(acks, 99) * 1000:.1f} ms')
+        else:
+            print('Socket Mode acks: 0')
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end benchmark of the gate against local Telegram and Slack stand-ins')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma-separated list of: ' + ', '.join(SCENARIOS))
+    parser.add_argument('--count', type=int, default=200, help='messages per scenario')
+    parser.add_argument('--projects', type=int, default=4)
+    parser.add_argument('--concurrency', type=int, default=16, help='concurrent HTTP requests of the load generator')
+    parser.add_argument('--rate', type=float, default=0, help='messages per second, 0 sends as fast as possible')
+    parser.add_argument('--latency', type=float, default=0.02, help='API latency of the stand-ins in seconds')
+    parser.add_argument('--jitter', type=float, default=0.01, help='random extra API latency in seconds')
+    parser.add_argument('--telegram-rate-limit', type=float, default=0, help='Telegram requests per second before 429, 0 is unlimited')
+    parser.add_argument('--slack-rate-limit', type=float, default=0, help='Slack requests per second before 429, 0 is unlimited')
+    parser.add_argument('--gate-rate-limits', action='store_true', help="keep the gate's own outbound rate limits")
+    parser.add_argument('--file-size', type=int, default=64 * 1024, help='size of the media files in bytes')
+    parser.add_argument('--runtime', choices=['threads', 'asyncio'], default='threads')
+    parser.add_argument('--ingestion', choices=['http', 'socket'], default='http', help='how Slack events reach the gate')
+    parser.add_argument('--gate-url', default='http://127.0.0.1:5555')
+    parser.add_argument('--timeout', type=float, default=60, help='seconds to wait for a scenario to be delivered')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--keep', action='store_true', help='keep the working directory with the log and database')
+    parser.add_argument('--check', action='store_true', help='exit with code 1 if a message was lost or a request failed')
+    args = parser.parse_args()
+
+    tracker = Tracker()
+    telegram = FakeTelegramServer(latency=args.latency, jitter=args.jitter, rate_limit=args.telegram_rate_limit,
+                                  on_marker=tracker.on_marker, file_size=args.file_size).start()
+    slack = FakeSlackServer(latency=args.latency, jitter=args.jitter, rate_limit=args.slack_rate_limit,
+                            on_marker=tracker.on_marker, file_size=args.file_size).start()
+    socket_mode = None
+    if args.ingestion == 'socket':
+        socket_mode = FakeSocketModeServer().start()
+        slack.socket_url = socket_mode.url
+
+    workdir = tempfile.mkdtemp(prefix='gate-bench-')
+    channels = write_config(workdir, args, telegram, slack)
+    process = start_gate(workdir)
+    results = []
+    try:
+        started = time.monotonic()
+        wait_until_ready(args.gate_url, process, timeout=60)
+        if socket_mode and not socket_mode.wait_for_connection(timeout=30):
+            raise RuntimeError('The gate did not open a Socket Mode connection in 30s')
+        print(f'Gate ready in {time.monotonic() - started:.2f}s, working directory {workdir}')
+        memory = MemorySampler(process.pid).start()
+        bench = Bench(args, channels, telegram, slack, tracker, socket_mode)
+        for name in args.scenarios.split(','):
+            results.append(bench.run_scenario(name.strip(), workdir, memory))
+        memory.stopped.set()
+    finally:
+        stop_gate(process)
+        telegram.shutdown()
+        slack.shutdown()
+        if socket_mode:
+            socket_mode.shutdown()
+
+    print_report(results, telegram, slack, socket_mode)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=2)
+    if args.keep:
+        print(f'Kept {workdir}')
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+    if args.check and any(result['lost'] or result['http_errors'] for result in results):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
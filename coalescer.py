@@ -0,0 +1,80 @@
+import time
+import logging
+import threading
+from storage import LRUCache
+
+# Debounced edit propagation. Edits of one target message that arrive within window
+# seconds of the first one are merged and only the latest is passed on when the window
+# closes. The text last sent to each target is remembered, so an edit that renders to
+# the same text does not cost an API call.
+
+class EditCoalescer:
+    def __init__(self, window=1.0, max_targets=10000):
+        self.window = window
+        self._cond = threading.Condition()
+        self._pending = {}   # target -> [due time, func, args]
+        self._sent_texts = LRUCache(max_targets)
+
+        self.submitted = 0
+        self.coalesced = 0
+        self.unchanged = 0
+
+    def start(self):
+        threading.Thread(target=self._run, name='edit-coalescer', daemon=True).start()
+        return self
+
+    # Call func(*args) when the window of target closes, replacing an edit waiting for it.
+    # func runs in the coalescer thread and should only hand the edit off.
+    def submit(self, target, func, *args):
+        with self._cond:
+            self.submitted += 1
+            if self.window > 0:
+                entry = self._pending.get(target)
+                if entry is not None:
+                    self.coalesced += 1
+                    entry[1:] = [func, args]
+                else:
+                    self._pending[target] = [time.monotonic() + self.window, func, args]
+                    self._cond.notify_all()
+                return
+        # Coalescing is disabled with window 0
+        func(*args)
+
+    # True if text is what was last sent to target
+    def is_unchanged(self, target, text):
+        if self._sent_texts.get(target) == text:
+            self.unchanged += 1
+            return True
+        return False
+
+    # Remember the text sent to target, after the API call succeeded
+    def remember(self, target, text):
+        self._sent_texts.put(target, text)
+
+    def _next_due(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                due = [target for target, entry in self._pending.items() if entry[0] <= now]
+                if due:
+                    return [self._pending.pop(target)[1:] for target in due]
+                wake_at = min([entry[0] for entry in self._pending.values()], default=None)
+                self._cond.wait(None if wake_at is None else wake_at - now)
+
+    def _run(self):
+        while True:
+            for func, args in self._next_due():
+                try:
+                    func(*args)
+                except Exception as e:
+                    logging.error(f"Error passing on a coalesced edit: {str(e)}")
+
+    def stats(self):
+        with self._cond:
+            pending = len(self._pending)
+        return {
+            'pending': pending,
+            'submitted': self.submitted,
+            'coalesced': self.coalesced,
+            'unchanged': self.unchanged,
+        }
@@ -0,0 +1,152 @@
+import time
+import heapq
+import logging
+import threading
+import itertools
+from collections import deque
+
+# Raised by a task that cannot make progress yet (e.g. its API calls are rate limited).
+# The task is put back at the head of its lane and run again after delay seconds; the
+# worker moves on to other lanes meanwhile.
+class TaskDeferred(Exception):
+    def __init__(self, delay, message=None):
+        super().__init__(message or f"Deferred for {delay:.1f}s")
+        self.delay = delay
+
+# Bounded worker pool that keeps events of one lane (project, channel) in order.
+# Each lane is processed by at most one worker at a time, so messages of a channel
+# are delivered in sequence while unrelated lanes run in parallel.
+class EventDispatcher:
+    def __init__(self, workers=8, max_queue=1000, submit_timeout=2.0, name='dispatcher'):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.submit_timeout = submit_timeout
+        self.name = name
+
+        self._cond = threading.Condition()
+        self._lanes = {}            # lane key -> deque of (func, args)
+        self._ready = deque()       # lane keys that have work and are not being processed
+        self._busy = set()          # lane keys currently owned by a worker
+        self._sleeping = []         # heap of (wake time, seq, lane key) of deferred lanes
+        self._sleep_seq = itertools.count()
+        self._depth = 0
+        self._stopping = False
+        self._threads = []
+
+        self.submitted = 0
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.overflows = 0
+        self.deferred = 0
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"{self.name}-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logging.debug(f"Event dispatcher started with {self.workers} workers, queue size {self.max_queue}")
+        return self
+
+    # Put an event in the lane queue. Blocks up to submit_timeout when the queue is full,
+    # after which the event is dropped and counted. Returns True if the event was accepted.
+    def submit(self, lane, func, *args):
+        with self._cond:
+            if self._depth >= self.max_queue:
+                self.overflows += 1
+                logging.warning(f"Dispatcher queue is full ({self._depth}), waiting for free slot for lane {lane}")
+                if not self._cond.wait_for(lambda: self._depth < self.max_queue or self._stopping, self.submit_timeout) \
+                        or self._stopping:
+                    self.dropped += 1
+                    logging.error(f"Dispatcher queue overflow, event dropped for lane {lane}")
+                    return False
+
+            queue = self._lanes.get(lane)
+            if queue is None:
+                queue = self._lanes[lane] = deque()
+            queue.append((func, args))
+            self._depth += 1
+            self.submitted += 1
+
+            if lane not in self._busy and len(queue) == 1:
+                self._ready.append(lane)
+            self._cond.notify_all()
+            return True
+
+    def _next_task(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                while self._sleeping and self._sleeping[0][0] <= now:
+                    self._ready.append(heapq.heappop(self._sleeping)[2])
+                if self._ready or self._stopping:
+                    break
+                self._cond.wait(self._sleeping[0][0] - now if self._sleeping else None)
+            if self._stopping and not self._ready:
+                return None, None
+            lane = self._ready.popleft()
+            self._busy.add(lane)
+            func, args = self._lanes[lane].popleft()
+            return lane, (func, args)
+
+    def _finish_task(self, lane, ok):
+        with self._cond:
+            if ok:
+                self.processed += 1
+            else:
+                self.failed += 1
+            self._busy.discard(lane)
+            self._depth -= 1
+            if self._lanes[lane]:
+                self._ready.append(lane)
+            else:
+                del self._lanes[lane]
+            self._cond.notify_all()
+
+    # Put a deferred task back at the head of its lane, the lane sleeps until delay passed
+    def _defer_task(self, lane, task, delay):
+        with self._cond:
+            self.deferred += 1
+            self._busy.discard(lane)
+            self._lanes[lane].appendleft(task)
+            heapq.heappush(self._sleeping, (time.monotonic() + delay, next(self._sleep_seq), lane))
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            lane, task = self._next_task()
+            if task is None:
+                return
+            func, args = task
+            try:
+                func(*args)
+            except TaskDeferred as e:
+                logging.debug(f"Lane {lane} deferred: {str(e)}")
+                self._defer_task(lane, task, e.delay)
+            except Exception as e:
+                logging.error(f"Error processing event in lane {lane}: {str(e)}")
+                self._finish_task(lane, False)
+            else:
+                self._finish_task(lane, True)
+
+    def stop(self, timeout=5):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'queue_depth': self._depth,
+                'active_lanes': len(self._lanes),
+                'busy_lanes': len(self._busy),
+                'submitted': self.submitted,
+                'processed': self.processed,
+                'failed': self.failed,
+                'dropped': self.dropped,
+                'overflows': self.overflows,
+                'deferred': self.deferred,
+                'sleeping_lanes': len(self._sleeping),
+            }
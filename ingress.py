@@ -0,0 +1,108 @@
+import os
+import logging
+from collections import OrderedDict
+from flask import Flask, request, jsonify
+from ipc import CoordinatorClient, CoordinatorError, EVENT_DROPPED
+from signing import verify_slack_signature
+import metrics
+
+# HTTP ingress served by the gunicorn workers. Workers do not open the database, load
+# the config or talk to Telegram and Slack: they pass every event to the coordinator
+# process (main.py) over a local unix socket and return at once.
+
+logging.basicConfig(
+    filename='integration.log',
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+coordinator = CoordinatorClient(
+    os.environ.get('GATE_IPC_ADDRESS', '/tmp/slack-telegram-gate.sock'),
+    bytes.fromhex(os.environ.get('GATE_IPC_AUTHKEY', ''))
+)
+telegram_webhook_secret = os.environ.get('GATE_TELEGRAM_WEBHOOK_SECRET')
+slack_signing_secret = os.environ.get('GATE_SLACK_SIGNING_SECRET')
+
+# Slack event ids recently passed to the coordinator by this worker
+recent_event_ids = OrderedDict()
+RECENT_EVENT_IDS_SIZE = 10000
+
+def remember_event_id(event_id):
+    if event_id:
+        recent_event_ids[event_id] = True
+        if len(recent_event_ids) > RECENT_EVENT_IDS_SIZE:
+            recent_event_ids.popitem(last=False)
+
+app = Flask(__name__)
+# Route to receive events from Slack
+@app.route('/slack/events', methods=['POST'])
+def slack_event_handler():
+    if slack_signing_secret and not verify_slack_signature(
+        slack_signing_secret,
+        request.headers.get('X-Slack-Request-Timestamp'),
+        request.get_data(),
+        request.headers.get('X-Slack-Signature')
+    ):
+        logging.warning("Slack request with a wrong signature rejected")
+        return '', 401
+
+    try:
+        data = request.json
+
+        # Process challenge from Slack (during initial setup)
+        if 'challenge' in data:
+            return jsonify({'challenge': data['challenge']})
+
+        # Slack retries of an event already passed on by this worker are answered at once
+        event_id = data.get('event_id')
+        if request.headers.get('X-Slack-Retry-Num') and event_id in recent_event_ids:
+            logging.debug(f"Slack retry of event {event_id} skipped")
+            return '', 200
+
+        # Immediately return the Slack response
+        if 'event' in data:
+            if coordinator.request('slack_event', {'event_id': event_id, 'event': data['event']}) == EVENT_DROPPED:
+                # The coordinator is overloaded, Slack retries the event later
+                return '', 503
+            remember_event_id(event_id)
+    except CoordinatorError as e:
+        # Slack retries the event later
+        logging.error(f"Error passing Slack event to the coordinator: {str(e)}")
+        return '', 503
+    except:
+        pass
+
+    return '', 200
+
+# Route to receive updates from Telegram in webhook mode
+@app.route('/telegram/webhook', methods=['POST'])
+def telegram_webhook_handler():
+    # Without a secret there is no way to tell Telegram from anyone else
+    if not telegram_webhook_secret or request.headers.get('X-Telegram-Bot-Api-Secret-Token') != telegram_webhook_secret:
+        logging.warning("Telegram webhook request with a wrong secret token rejected")
+        return '', 403
+
+    try:
+        coordinator.request('telegram_update', request.get_data().decode('utf-8'))
+    except CoordinatorError as e:
+        # Telegram retries the update later
+        logging.error(f"Error passing Telegram update to the coordinator: {str(e)}")
+        return '', 503
+
+    return '', 200
+
+# Routes to check the coordinator counters
+@app.route('/<any(dispatcher, outbound, users, outbox, dedupe, edits, retention, socket):name>/stats', methods=['GET'])
+def stats_handler(name):
+    try:
+        return jsonify(coordinator.request('stats', name))
+    except CoordinatorError as e:
+        return jsonify({'error': str(e)}), 503
+
+# Prometheus metrics of the coordinator
+@app.route('/metrics', methods=['GET'])
+def metrics_handler():
+    try:
+        return coordinator.request('metrics'), 200, {'Content-Type': metrics.CONTENT_TYPE}
+    except CoordinatorError as e:
+        return str(e), 503
@@ -0,0 +1,78 @@
+import os
+import logging
+import threading
+from multiprocessing.connection import Listener, Client
+
+# Local IPC between the gunicorn workers and the coordinator process.
+# Workers send (kind, payload) requests over a unix socket, the coordinator runs the
+# handler registered for kind and sends back ('ok', result) or ('error', message).
+
+class CoordinatorError(Exception):
+    pass
+
+# Results of slack_event requests. A dropped event is answered with 503, so Slack retries it.
+EVENT_ACCEPTED = 'accepted'
+EVENT_DUPLICATE = 'duplicate'
+EVENT_DROPPED = 'dropped'
+
+class CoordinatorServer:
+    def __init__(self, address, authkey, handlers):
+        self.address = address
+        self.authkey = authkey
+        self.handlers = handlers
+        self._listener = None
+
+    def start(self):
+        if os.path.exists(self.address):
+            os.remove(self.address)
+        self._listener = Listener(self.address, family='AF_UNIX', authkey=self.authkey)
+        threading.Thread(target=self._accept, name='coordinator-accept', daemon=True).start()
+        logging.info(f"Coordinator is listening on {self.address}")
+        return self
+
+    def _accept(self):
+        while True:
+            try:
+                conn = self._listener.accept()
+            except Exception as e:
+                logging.error(f"Error accepting coordinator connection: {str(e)}")
+                continue
+            threading.Thread(target=self._serve, args=(conn,), name='coordinator-conn', daemon=True).start()
+
+    def _serve(self, conn):
+        with conn:
+            while True:
+                try:
+                    kind, payload = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    conn.send(('ok', self.handlers[kind](payload)))
+                except Exception as e:
+                    logging.error(f"Error handling coordinator request {kind}: {str(e)}")
+                    conn.send(('error', str(e)))
+
+# One connection per worker process, reconnected once if the coordinator restarted
+class CoordinatorClient:
+    def __init__(self, address, authkey):
+        self.address = address
+        self.authkey = authkey
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def request(self, kind, payload=None):
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._conn is None:
+                        self._conn = Client(self.address, family='AF_UNIX', authkey=self.authkey)
+                    self._conn.send((kind, payload))
+                    status, result = self._conn.recv()
+                    break
+                except (EOFError, OSError) as e:
+                    self._conn = None
+                    if attempt:
+                        raise CoordinatorError(f"Coordinator is not available: {str(e)}")
+        if status != 'ok':
+            raise CoordinatorError(result)
+        return result
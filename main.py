@@ -1,14 +1,23 @@
 from utils import download_file_from_slack, process_reply_message, find_project_by_chat_id, get_slack_username, find_project_by_slack_channel
-from utils import get_server_ip, start_config_monitor, process_reply_to_message, update_slack_thread_ts_by_string, save_thread_ts, load_config
-from utils import get_telegram_message_id_by_thread_ts, get_thread_ts_from_slack
-from flask import Flask, request, jsonify
-from slack_sdk import WebClient
+from utils import start_config_monitor, process_reply_to_message, update_slack_thread_ts_by_string, save_thread_ts, load_config
+from utils import get_telegram_message_id_by_thread_ts, get_thread_ts_from_slack, flush_mappings, get_slack_client, get_http_session, user_cache
+from utils import remove_downloaded_file, init_storage, init_retention, get_project_bot_member_id, get_public_url, get_telegram_api_url, DB_PATH
+from utils import get_slack_api_url, get_telegram_mode, config_listeners
+from dispatcher import EventDispatcher
+from outbound import OutboundScheduler, PRIORITY_EDIT
+from media import MediaTransferLimiter, MediaTooLarge, download_to_spool, upload_spool_to_slack
+from media import ALBUM_MIMETYPES, group_slack_files, file_part_id
+from ipc import CoordinatorServer, EVENT_ACCEPTED, EVENT_DUPLICATE, EVENT_DROPPED
+from outbox import Outbox
+from coalescer import EditCoalescer
+from socket_mode import SocketModeReceiver
+from storage import EventDeduper, LRUCache
+import metrics
+from concurrent.futures import ThreadPoolExecutor
 import subprocess
 import threading
 import telebot
 import logging
-import sqlite3
-import requests
 import signal
 import time
 import sys
@@ -21,20 +30,110 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
-current_config = load_config()
-conn = sqlite3.connect('messages.db', check_same_thread=False)
-cursor = conn.cursor()
+startup_started = time.monotonic()
+first_event_logged = False
 stop_event = threading.Event()
 
-# Setting up a Telegram bot
-telegram_bot = telebot.TeleBot(current_config['settings']['telegram_bot_gate_token'])
-logging.debug("Telegram bot configured")
+# Components of the coordinator, created by init()
+settings = None
+telegram_bot = None
+media_limiter = None
+file_download_pool = None
+outbound = None
+event_dispatcher = None
+outbox = None
+event_deduper = None
+edit_coalescer = None
+retention = None
+socket_receiver = None
+mapping_store = None
+
+# Explicit initialization phase: nothing is started or opened when main is imported
+def init(config):
+    global settings, telegram_bot, media_limiter, file_download_pool
+    global outbound, event_dispatcher, outbox, event_deduper, edit_coalescer, retention, socket_receiver, mapping_store
+    settings = config['settings']
+    mapping_store = init_storage(settings.get('database_per_project', False))
+
+    # Setting up a Telegram bot
+    telegram_api_url = get_telegram_api_url(settings)
+    telebot.apihelper.API_URL = telegram_api_url + '/bot{0}/{1}'
+    telebot.apihelper.FILE_URL = telegram_api_url + '/file/bot{0}/{1}'
+    telegram_bot = telebot.TeleBot(settings['telegram_bot_gate_token'])
+    telegram_bot.register_message_handler(handle_media_message, content_types=['text','photo', 'document', 'audio', 'video', 'animation', 'voice'])
+    telegram_bot.register_edited_message_handler(handle_telegram_message_edit, content_types=['text', 'photo', 'document', 'audio', 'video', 'animation', 'voice'])
+    logging.debug("Telegram bot configured")
+
+    # Limits for Telegram -> Slack media transfers
+    media_limiter = MediaTransferLimiter(
+        max_concurrent=settings.get('media_max_concurrent', 4),
+        memory_limit=settings.get('media_memory_limit', 1024 * 1024),
+        max_size=settings.get('media_max_size', 50 * 1024 * 1024)
+    )
+
+    # Parallel downloads of Slack files
+    file_download_pool = ThreadPoolExecutor(max_workers=settings.get('file_download_workers', 8))
+
+    # Rate-limit-aware scheduler for Telegram and Slack API calls
+    outbound = OutboundScheduler(
+        workers=settings.get('outbound_workers', 8),
+        rate_limits={name: tuple(limit) for name, limit in (settings.get('rate_limits') or {}).items()},
+        max_wait=settings.get('outbound_max_wait', 1.0)
+    ).start()
+
+    # Bounded worker pool for Slack events and Telegram messages, one ordered lane per
+    # (project, channel). A lane whose API calls are rate limited is deferred, so it
+    # does not hold a worker.
+    event_dispatcher = EventDispatcher(
+        workers=settings.get('dispatcher_workers', 8),
+        max_queue=settings.get('dispatcher_queue_size', 1000),
+        submit_timeout=settings.get('dispatcher_submit_timeout', 2.0)
+    ).start()
+
+    # Every bridged message and edit is recorded in the outbox before delivery
+    outbox = Outbox(DB_PATH, mapping_store.writer, {
+        'slack_message': deliver_slack_message,
+        'slack_edit': deliver_slack_edit,
+        'telegram_message': deliver_telegram_message,
+        'telegram_edit': deliver_telegram_edit,
+    }, max_attempts=settings.get('outbox_max_attempts', 8)).start(workers=settings.get('outbox_workers', 2))
+
+    # Slack event deduplication by event_id and (channel, ts)
+    event_deduper = EventDeduper(DB_PATH, mapping_store.writer, window=settings.get('dedupe_window', 10000))
+
+    # Bursts of edits of one message are sent as one edit after edit_window seconds
+    edit_coalescer = EditCoalescer(window=settings.get('edit_window', 1.0)).start()
+
+    # Old mappings and outbox entries are deleted in the background
+    retention = init_retention(settings)
+
+    # Projects with slack_ingestion: socket receive Slack events over Socket Mode,
+    # connections are opened in the background and follow config reloads
+    socket_receiver = SocketModeReceiver(handle_slack_event_request, get_slack_api_url(settings))
+    config_listeners.append(socket_receiver.sync)
+    threading.Thread(target=socket_receiver.sync, args=(config,), daemon=True).start()
+
+    # Gauges served at /metrics
+    metrics.db_write_queue.set_function(mapping_store.writer.queue_depth)
+    metrics.in_flight.set_function(lambda: event_dispatcher.stats()['queue_depth'], kind='dispatcher_queue')
+    metrics.in_flight.set_function(lambda: event_dispatcher.stats()['busy_lanes'], kind='dispatcher_busy_lanes')
+    metrics.in_flight.set_function(lambda: outbound.stats()['pending'], kind='outbound_pending')
+    metrics.in_flight.set_function(lambda: media_limiter.in_flight, kind='media_transfers')
+    metrics.in_flight.set_function(threading.active_count, kind='threads')
+
+# Rate limit buckets of the Telegram chat and the Slack channel of a project
+def telegram_keys(project):
+    return [('telegram',), ('telegram_chat', str(project['telegram_chat_id']))]
+
+def slack_keys(project, method):
+    return [(f'slack_{method}', project['slack_channel_id'])]
 
 def send_text_to_slack(message, slack_client, project, sender_name, telegram_username):
     thread_ts = process_reply_message(message, project)
 
     slack_message_text = f"{sender_name} \n{telegram_username}\n\n{message.text}"
-    slack_response = slack_client.chat_postMessage(
+    slack_response = outbound.call(
+        slack_keys(project, 'post'), slack_client.chat_postMessage,
         channel=project['slack_channel_id'],
         text=slack_message_text,
         thread_ts=thread_ts  
@@ -63,32 +162,44 @@ def send_media_to_slack(message, slack_client, project, sender_name, telegram_us
         logging.error(f"Unknown content type: {message.content_type}")
         return
 
+    # The file is not downloaded while its upload would be deferred anyway
+    outbound.defer_if_limited(slack_keys(project, 'files'), 'files upload')
     file_info = telegram_bot.get_file(file_id)
-    file_url = f'https://api.telegram.org/file/bot{current_config["settings"]["telegram_bot_gate_token"]}/{file_info.file_path}'
+    if file_info.file_size and file_info.file_size > media_limiter.max_size:
+        logging.error(f"File {file_info.file_path} is too large to forward: {file_info.file_size} bytes")
+        return
+    file_url = telebot.apihelper.FILE_URL.format(settings['telegram_bot_gate_token'], file_info.file_path)
     filename = file_info.file_path.split('/')[-1]
+    session = get_http_session('telegram')
 
-    file_response = requests.get(file_url)
-    if file_response.status_code == 200:
-        logging.debug(f"The file was successfully downloaded from Telegram: {file_url}")
-        slack_message_text = f"{sender_name} \n{telegram_username}"
+    with media_limiter:
+        # Download errors go up to the outbox and are retried, a file over the limit is not
+        try:
+            spool, size = download_to_spool(session, file_url, media_limiter)
+        except MediaTooLarge as e:
+            logging.error(f"Error downloading file from Telegram: {str(e)}, URL: {file_url}")
+            return
 
-        slack_response = slack_client.files_upload_v2(
-            channel=project['slack_channel_id'],
-            file=file_response.content,
-            filename=filename,
-            title=message.caption or "Media from Telegram",
-            initial_comment=slack_message_text,
-            thread_ts=thread_ts
-        )
+        with spool:
+            logging.debug(f"The file was successfully downloaded from Telegram: {file_url}, size: {size}")
+            slack_message_text = f"{sender_name} \n{telegram_username}"
 
-        if slack_response["ok"]:
-            file_timestamp = slack_response['file']['id']
-            logging.debug(f"Media file sent to Slack for the project {project['project_name']} with ts={file_timestamp}")
-            save_thread_ts(message.message_id, file_timestamp, project['project_name'])
-        else:
-            logging.error(f"Error sending file to Slack: {slack_response['error']}")
-    else:
-        logging.error(f"Error downloading file from Telegram: status {file_response.status_code}, URL: {file_url}")
+            def upload():
+                # A retried upload starts from the beginning of the file
+                spool.seek(0)
+                return upload_spool_to_slack(
+                    slack_client, get_http_session('slack'), spool, size, media_limiter,
+                    channel=project['slack_channel_id'],
+                    filename=filename,
+                    title=message.caption or "Media from Telegram",
+                    initial_comment=slack_message_text,
+                    thread_ts=thread_ts
+                )
+
+            file_timestamp = outbound.call(slack_keys(project, 'files'), upload)
+
+    logging.debug(f"Media file sent to Slack for the project {project['project_name']} with ts={file_timestamp}")
+    save_thread_ts(message.message_id, file_timestamp, project['project_name'])
 
 # Function for processing messages from Slack and forwarding them to Telegram
 def handle_slack_message(event):
@@ -98,157 +209,331 @@ def handle_slack_message(event):
     update_slack_thread_ts_by_string(event, project)
 
     if project:
-        slack_bot_member_id = project.get('slack_bot_member_id')
+        slack_bot_member_id = get_project_bot_member_id(project)
         if event.get('user') == slack_bot_member_id:
             logging.debug(f"Message sent by Slack bot {slack_bot_member_id}, skip forwarding.")
             return
 
     if project and project['active']:
-        slack_token = project['slack_bot_token']
-        slack_client = WebClient(token=slack_token)
-
-        slack_user_id = event.get('user')
-        slack_username = get_slack_username(slack_client, slack_user_id)
-        slack_user_id_tag = f"<@{slack_user_id}>"
-        
-        try:
-            reply_to_message_id, thread_ts = process_reply_to_message(event, project)
-
-            if 'files' in event:
-                for file in event['files']:
-                    telegram_response = send_file_to_telegram(
-                        file, slack_token, slack_username, slack_user_id_tag,
-                        event, project, reply_to_message_id
-                    )
-                    if telegram_response:
-                        save_thread_ts(telegram_response.message_id, thread_ts, project['project_name'])
-            else:
-                telegram_response = send_text_to_telegram(event, slack_username, slack_user_id_tag, project, reply_to_message_id)
-                save_thread_ts(telegram_response.message_id, thread_ts, project['project_name'])
-                return
-          
-        except Exception as e:
-            logging.error(f"Error when sending a message to Telegram for a project {project['project_name']}: {str(e)}")
+        outbox.submit(f"slack:{project['project_name']}:{event['channel']}:{event.get('ts')}", 'slack_message', event)
     else:
         logging.warning(f"Project not found or not active for Slack channel_id={event['channel']}")
 
+# Outbox handler: forward a Slack message to Telegram, errors are retried by the outbox
+def deliver_slack_message(event):
+    project = find_project_by_slack_channel(event['channel'])
+    if not project or not project['active']:
+        logging.warning(f"Project not found or not active for Slack channel_id={event['channel']}, message dropped")
+        return
+
+    slack_token = project['slack_bot_token']
+    slack_client = get_slack_client(slack_token)
+
+    slack_user_id = event.get('user')
+    slack_username = get_slack_username(slack_client, slack_user_id)
+    slack_user_id_tag = f"<@{slack_user_id}>"
+
+    reply_to_message_id, thread_ts = process_reply_to_message(event, project)
+
+    if 'files' in event:
+        telegram_message_ids = send_files_to_telegram(
+            event['files'], slack_token, slack_username, slack_user_id_tag,
+            event, project, reply_to_message_id
+        )
+        for telegram_message_id in telegram_message_ids:
+            save_thread_ts(telegram_message_id, thread_ts, project['project_name'])
+        metrics.messages_bridged.inc(project=project['project_name'], direction='slack_to_telegram', content_type='file')
+    else:
+        telegram_response = send_text_to_telegram(event, slack_username, slack_user_id_tag, project, reply_to_message_id)
+        save_thread_ts(telegram_response.message_id, thread_ts, project['project_name'])
+        metrics.messages_bridged.inc(project=project['project_name'], direction='slack_to_telegram', content_type='text')
+
 def handle_slack_message_changed(event):
     logging.debug(f"Handling edited message from Slack: channel_id={event['channel']}")
     project = find_project_by_slack_channel(event['channel'])
     
     if project and project['active']:
-        slack_token = project['slack_bot_token']
-        slack_client = WebClient(token=slack_token)
-        slack_user_id = event['message'].get('user')
-        slack_username = get_slack_username(slack_client, slack_user_id)
-        slack_user_id_tag = f"<@{slack_user_id}>"
-        
-        # Find original message by ts
-        original_thread_ts = event['previous_message']['ts']
-        edited_text = event['message']['text']
-        
-        try:
-            #Updating a message in Telegram
-            telegram_message_id = get_telegram_message_id_by_thread_ts(original_thread_ts, project['project_name'])
-            telegram_message_text = f"{slack_username} \n{slack_user_id_tag}\n\n{edited_text}"
-            telegram_bot.edit_message_text(
-                chat_id=project['telegram_chat_id'],
-                message_id=telegram_message_id,
-                text=telegram_message_text
-            )
-            logging.debug(f"Telegram message {telegram_message_id} updated for project {project['project_name']}")
-        except Exception as e:
-            logging.error(f"Error when editing Telegram message: {str(e)}")
+        # Slack also sends message_changed for link previews and other changes that
+        # leave the text as it was
+        if event['message'].get('text') == event['previous_message'].get('text'):
+            logging.debug(f"Slack edit of {event['previous_message']['ts']} does not change the text, skipping")
+            return
+        target = (project['project_name'], 'slack', event['previous_message']['ts'])
+        edit_coalescer.submit(target, dispatch_edit, get_slack_event_lane(event), submit_slack_edit, event)
+
+# Called by the edit coalescer: the latest edit of a message goes back to its lane
+def dispatch_edit(lane, func, *args):
+    if not event_dispatcher.submit(lane, func, *args):
+        logging.error(f"Edit dropped, the dispatcher queue is full: lane {lane}")
+
+def submit_slack_edit(event):
+    project = find_project_by_slack_channel(event['channel'])
+    if project and project['active']:
+        key = f"slack_edit:{project['project_name']}:{event['channel']}:{event['previous_message']['ts']}:{event.get('event_ts')}"
+        outbox.submit(key, 'slack_edit', event)
+
+# Outbox handler: apply a Slack edit to the Telegram message
+def deliver_slack_edit(event):
+    project = find_project_by_slack_channel(event['channel'])
+    if not project or not project['active']:
+        return
+
+    slack_token = project['slack_bot_token']
+    slack_client = get_slack_client(slack_token)
+    slack_user_id = event['message'].get('user')
+    slack_username = get_slack_username(slack_client, slack_user_id)
+    slack_user_id_tag = f"<@{slack_user_id}>"
+
+    # Find original message by ts
+    original_thread_ts = event['previous_message']['ts']
+    edited_text = event['message']['text']
+
+    #Updating a message in Telegram
+    telegram_message_id = get_telegram_message_id_by_thread_ts(original_thread_ts, project['project_name'])
+    if telegram_message_id is None:
+        logging.warning(f"Telegram message not found for Slack ts {original_thread_ts}")
+        return
+    telegram_message_text = f"{slack_username} \n{slack_user_id_tag}\n\n{edited_text}"
+    target = (project['project_name'], 'slack', original_thread_ts)
+    if edit_coalescer.is_unchanged(target, telegram_message_text):
+        logging.debug(f"Telegram message {telegram_message_id} already has this text, skipping")
+        return
+
+    if event['message'].get('files'):
+        # Files were sent to Telegram as media with the text in the caption
+        outbound.call(
+            telegram_keys(project), telegram_bot.edit_message_caption,
+            chat_id=project['telegram_chat_id'],
+            message_id=telegram_message_id,
+            caption=telegram_message_text,
+            priority=PRIORITY_EDIT
+        )
+    else:
+        outbound.call(
+            telegram_keys(project), telegram_bot.edit_message_text,
+            chat_id=project['telegram_chat_id'],
+            message_id=telegram_message_id,
+            text=telegram_message_text,
+            priority=PRIORITY_EDIT
+        )
+    edit_coalescer.remember(target, telegram_message_text)
+    logging.debug(f"Telegram message {telegram_message_id} updated for project {project['project_name']}")
 
 # Add message change processing to the main Slack event handler
 def process_slack_event(event):
     if event.get('subtype') == 'message_changed':
         handle_slack_message_changed(event)
+    elif event.get('type') == 'user_change':
+        user_cache.invalidate(event['user']['id'])
+        logging.debug(f"Slack user {event['user']['id']} changed, removed from the user cache")
     elif event.get('type') == 'message':
         handle_slack_message(event)
     else:
         logging.debug(f"Skipping an irrelevant Slack event: {event['type']}")
 
+# Lane key for a Slack event: events of one channel keep their order within a project
+def get_slack_event_lane(event):
+    channel_id = event.get('channel')
+    project = find_project_by_slack_channel(channel_id) if channel_id else None
+    project_name = project['project_name'] if project else None
+    return (project_name, channel_id)
+
 # Processing messages in Telegram (text, photos, documents, audio, video, animations, voice messages)
-@telegram_bot.message_handler(content_types=['text','photo', 'document', 'audio', 'video', 'animation', 'voice'])
 def handle_media_message(message):
     logging.debug(f"Processing a message from Telegram: chat_id={message.chat.id}, message_id={message.message_id}, type: {message.content_type}")
     handle_telegram_message(message)
 
-@telegram_bot.edited_message_handler(content_types=['text'])
 def handle_telegram_message_edit(message):
     logging.debug(f"Handling edited message from Telegram: chat_id={message.chat.id}, message_id={message.message_id}, type: {message.content_type}")
     
     project = find_project_by_chat_id(message.chat.id)
     
     if project and project['active']:
-        try:
-            slack_token = project['slack_bot_token']
-            slack_client = WebClient(token=slack_token)
-            slack_ts = get_thread_ts_from_slack(message.message_id, project['project_name'])
-            
-            if slack_ts:
-                edited_text = message.text
-                slack_client.chat_update(
-                    channel=project['slack_channel_id'],
-                    ts=slack_ts,
-                    text=edited_text
-                )
-                logging.debug(f"Message updated in Slack for project {project['project_name']} with ts={slack_ts}")
-            else:
-                logging.warning(f"Slack thread_ts not found for Telegram message {message.message_id}")
-        except Exception as e:
-            logging.error(f"Error when editing Slack message: {str(e)}")
+        target = (project['project_name'], 'telegram', message.message_id)
+        lane = (project['project_name'], f'telegram:{message.chat.id}')
+        edit_coalescer.submit(target, dispatch_edit, lane, submit_telegram_edit, message)
+
+def submit_telegram_edit(message):
+    project = find_project_by_chat_id(message.chat.id)
+    if project and project['active']:
+        key = f"telegram_edit:{project['project_name']}:{message.chat.id}:{message.message_id}:{message.edit_date}"
+        outbox.submit(key, 'telegram_edit', message.json)
+
+# Outbox handler: apply a Telegram edit to the Slack message
+def deliver_telegram_edit(message_json):
+    message = telebot.types.Message.de_json(message_json)
+    project = find_project_by_chat_id(message.chat.id)
+    if not project or not project['active']:
+        return
+
+    slack_token = project['slack_bot_token']
+    slack_client = get_slack_client(slack_token)
+    slack_ts = get_thread_ts_from_slack(message.message_id, project['project_name'])
+
+    if slack_ts:
+        if message.content_type == 'text':
+            edited_text = message.text
+        else:
+            # A caption edit replaces the text of the Slack file message
+            sender_name = message.from_user.full_name if message.from_user else "Unknown"
+            telegram_username = f"@{message.from_user.username}" if message.from_user and message.from_user.username else ""
+            edited_text = f"{sender_name} \n{telegram_username}\n\n{message.caption or ''}"
+
+        target = (project['project_name'], 'telegram', message.message_id)
+        if edit_coalescer.is_unchanged(target, edited_text):
+            logging.debug(f"Slack message {slack_ts} already has this text, skipping")
+            return
+        outbound.call(
+            slack_keys(project, 'update'), slack_client.chat_update,
+            channel=project['slack_channel_id'],
+            ts=slack_ts,
+            text=edited_text,
+            priority=PRIORITY_EDIT
+        )
+        edit_coalescer.remember(target, edited_text)
+        logging.debug(f"Message updated in Slack for project {project['project_name']} with ts={slack_ts}")
+    else:
+        logging.warning(f"Slack thread_ts not found for Telegram message {message.message_id}")
 
 def handle_telegram_message(message):
     logging.debug(f"Received message from Telegram: chat_id={message.chat.id}, content_type={message.content_type}, message_id={message.message_id}")
     project = find_project_by_chat_id(message.chat.id)
     
     if project and project['active']:
-        slack_token = project['slack_bot_token']
-        slack_client = WebClient(token=slack_token)
-        sender_name = message.from_user.full_name if message.from_user else "Unknown"
-        telegram_username = f"@{message.from_user.username}" if message.from_user.username else ""
+        key = f"telegram:{project['project_name']}:{message.chat.id}:{message.message_id}"
+        # Recorded first, so a message dropped by a full dispatcher is still delivered by the outbox workers
+        outbox.record(key, 'telegram_message', message.json)
+        lane = (project['project_name'], f'telegram:{message.chat.id}')
+        if not event_dispatcher.submit(lane, outbox.deliver, key):
+            logging.warning(f"Dispatcher queue is full, Telegram message {message.message_id} is left to the outbox workers")
+
+# Outbox handler: forward a Telegram message to Slack, errors are retried by the outbox
+def deliver_telegram_message(message_json):
+    message = telebot.types.Message.de_json(message_json)
+    project = find_project_by_chat_id(message.chat.id)
+    if not project or not project['active']:
+        return
 
-        try:
-            if message.content_type == 'text':
-                send_text_to_slack(message, slack_client, project, sender_name, telegram_username)
-            elif message.content_type in ['photo', 'document', 'audio', 'video', 'animation', 'voice']:
-                send_media_to_slack(message, slack_client, project, sender_name, telegram_username)
-            else:
-                logging.error(f"Content type error: {message.content_type}")
-        except Exception as e:
-            logging.error(f"Error when processing a message from Telegram: {str(e)}")
-
-def send_file_to_telegram(file, slack_token, slack_username, slack_user_id_tag, event, project, reply_to_message_id):
-    file_url = file['url_private']
-    local_file = download_file_from_slack(file_url, slack_token)
-    if local_file:
-        telegram_message = f"{slack_username} \n{slack_user_id_tag}"
-        if 'text' in event and event['text']:
-            telegram_message += f"\n\n{event['text']}"
-        
-        try:
-            with open(local_file, 'rb') as f:
-                telegram_response = telegram_bot.send_document(
-                    project['telegram_chat_id'],
-                    f,
-                    caption=telegram_message,
-                    reply_to_message_id=reply_to_message_id
-                )
-            logging.debug(f"The file was sent to Telegram for the project {project['project_name']}, message_id={telegram_response.message_id}")
-        except Exception as e:
-            logging.error(f"Error when sending a file to Telegram: {str(e)}")
-        finally:
-            os.remove(local_file)  
-        return telegram_response
+    slack_token = project['slack_bot_token']
+    slack_client = get_slack_client(slack_token)
+    sender_name = message.from_user.full_name if message.from_user else "Unknown"
+    telegram_username = f"@{message.from_user.username}" if message.from_user and message.from_user.username else ""
+
+    if message.content_type == 'text':
+        send_text_to_slack(message, slack_client, project, sender_name, telegram_username)
+    elif message.content_type in ['photo', 'document', 'audio', 'video', 'animation', 'voice']:
+        send_media_to_slack(message, slack_client, project, sender_name, telegram_username)
     else:
-        logging.error("The file was not uploaded from Slack.")
-    return None
+        logging.error(f"Content type error: {message.content_type}")
+        return
+    metrics.messages_bridged.inc(project=project['project_name'], direction='telegram_to_slack', content_type=message.content_type)
+
+# Parts of Slack file messages already sent to Telegram, so a retried delivery only
+# sends the rest: (project, channel, ts) -> {part: [Telegram message ids]}
+sent_file_parts = LRUCache(1000)
+
+# Returns the Telegram message ids of all sent files. Errors go up to the outbox,
+# a retry skips the parts that were already sent.
+def send_files_to_telegram(files, slack_token, slack_username, slack_user_id_tag, event, project, reply_to_message_id):
+    telegram_message = f"{slack_username} \n{slack_user_id_tag}"
+    if 'text' in event and event['text']:
+        telegram_message += f"\n\n{event['text']}"
+
+    parts = group_slack_files(files, media_limiter.max_size)
+
+    progress_key = (project['project_name'], event['channel'], event.get('ts'))
+    sent_parts = sent_file_parts.get(progress_key) or {}
+    if sent_parts:
+        # The text went with the first part that was sent
+        telegram_message = None
+    pending_parts = [part for part in parts if file_part_id(part) not in sent_parts]
+
+    # Download the files of all pending parts in parallel, unless sending them would be deferred
+    if pending_parts:
+        outbound.defer_if_limited(telegram_keys(project), 'send_files_to_telegram')
+    pending_files = [file for part in pending_parts for file in part]
+    download_futures = [
+        file_download_pool.submit(download_file_from_slack, file['url_private'], slack_token) for file in pending_files
+    ]
+    local_files = []
+    failed_parts = 0
+    try:
+        # Every download is waited for, so none of them is left behind on disk when another fails
+        for future in download_futures:
+            try:
+                local_files.append(future.result())
+            except Exception as e:
+                logging.error(f"Error downloading a file from Slack: {str(e)}")
+                local_files.append(None)
+        local_file_by_id = {file_part_id([file]): local_file for file, local_file in zip(pending_files, local_files)}
+
+        for part in pending_parts:
+            part_files = [local_file_by_id[file_part_id([file])] for file in part]
+            if not all(part_files):
+                failed_parts += 1
+                continue
+            if len(part) > 1:
+                telegram_responses = send_album_to_telegram(list(zip(part, part_files)), telegram_message, project, reply_to_message_id)
+            else:
+                telegram_responses = [send_file_to_telegram(part_files[0], telegram_message, project, reply_to_message_id)]
+            telegram_message = None
+            sent_parts[file_part_id(part)] = [response.message_id for response in telegram_responses]
+            sent_file_parts.put(progress_key, sent_parts)
+    finally:
+        for local_file in local_files:
+            if local_file:
+                remove_downloaded_file(local_file)
+
+    if failed_parts:
+        raise RuntimeError(f"{failed_parts} of {len(parts)} file groups could not be downloaded from Slack")
+    sent_file_parts.pop(progress_key)
+    return [message_id for part in parts for message_id in sent_parts.get(file_part_id(part), [])]
+
+def send_album_to_telegram(album, caption, project, reply_to_message_id):
+    opened_files = []
+    try:
+        media = []
+        for file, local_file in album:
+            f = open(local_file, 'rb')
+            opened_files.append(f)
+            media.append(ALBUM_MIMETYPES[file['mimetype']](f, caption=caption if not media else None))
+
+        def send():
+            # A retried album is read from the beginning of its files
+            for f in opened_files:
+                f.seek(0)
+            return telegram_bot.send_media_group(
+                project['telegram_chat_id'],
+                media,
+                reply_to_message_id=reply_to_message_id
+            )
+
+        telegram_responses = outbound.call(telegram_keys(project), send)
+        logging.debug(f"An album of {len(media)} files was sent to Telegram for the project {project['project_name']}")
+        return telegram_responses
+    finally:
+        for f in opened_files:
+            f.close()
+
+def send_file_to_telegram(local_file, caption, project, reply_to_message_id):
+    with open(local_file, 'rb') as f:
+        def send():
+            f.seek(0)
+            return telegram_bot.send_document(
+                project['telegram_chat_id'],
+                f,
+                caption=caption,
+                reply_to_message_id=reply_to_message_id
+            )
+
+        telegram_response = outbound.call(telegram_keys(project), send)
+    logging.debug(f"The file was sent to Telegram for the project {project['project_name']}, message_id={telegram_response.message_id}")
+    return telegram_response
 
 def send_text_to_telegram(event, slack_username, slack_user_id_tag, project, reply_to_message_id):
     telegram_message = f"{slack_username} \n{slack_user_id_tag}\n\n{event['text']}"
-    telegram_response = telegram_bot.send_message(
+    telegram_response = outbound.call(
+        telegram_keys(project), telegram_bot.send_message,
         project['telegram_chat_id'],
         telegram_message,
         reply_to_message_id=reply_to_message_id
@@ -262,59 +547,149 @@ def run_telegram_bot():
     while True:
         try:
             logging.debug("Launching a Telegram bot survey")
+            # A webhook left by an earlier run in webhook mode makes getUpdates fail with 409
+            telegram_bot.remove_webhook()
             while not stop_event.is_set():
                 telegram_bot.polling(none_stop=True, timeout=5) 
         except Exception as e:
             logging.critical(f"Critical error in Telegram bot: {str(e)}")
             time.sleep(5)
 
+# Register the webhook with Telegram, updates are then pushed to /telegram/webhook
+def set_telegram_webhook(retry_delay=5):
+    webhook_url = settings['telegram_webhook_url']
+    while not stop_event.is_set():
+        try:
+            telegram_bot.remove_webhook()
+            telegram_bot.set_webhook(url=webhook_url, secret_token=settings.get('telegram_webhook_secret'))
+            logging.info(f"Telegram webhook set to {webhook_url}")
+            return
+        except Exception as e:
+            logging.error(f"Error setting the Telegram webhook, retrying in {retry_delay}s: {str(e)}")
+            stop_event.wait(retry_delay)
+
 # Function to terminate the program correctly
 def signal_handler(sig, frame):
     logging.info('Received SIGINT, shutting down...')
     stop_event.set()  
+    flush_mappings()
     sys.exit(0)
 
-signal.signal(signal.SIGINT, signal_handler)
+# Requests from the gunicorn workers (ingress.py), served by the coordinator process
+@metrics.stage_seconds.time(stage='ingest')
+def handle_slack_event_request(payload):
+    global first_event_logged
+    event = payload['event']
+    if not first_event_logged:
+        first_event_logged = True
+        logging.info(f"First Slack event received {(time.monotonic() - startup_started) * 1000:.0f} ms after start")
+    # Slack retries are rejected before they take a dispatcher slot
+    event_keys = (payload.get('event_id'), event.get('channel'), event.get('ts'))
+    if not event_deduper.check_and_mark(*event_keys):
+        logging.debug(f"Duplicate Slack event {payload.get('event_id')} skipped")
+        return EVENT_DUPLICATE
+    if not event_dispatcher.submit(get_slack_event_lane(event), process_slack_event, event):
+        # Not seen after all, so the retry of the dropped event is accepted
+        event_deduper.unmark(*event_keys)
+        return EVENT_DROPPED
+    return EVENT_ACCEPTED
+
+@metrics.stage_seconds.time(stage='ingest')
+def handle_telegram_update_request(update_json):
+    update = telebot.types.Update.de_json(update_json)
+    telegram_bot.process_new_updates([update])
+
+def handle_stats_request(name):
+    return {
+        'dispatcher': event_dispatcher.stats,
+        'outbound': outbound.stats,
+        'users': user_cache.stats,
+        'outbox': outbox.stats,
+        'dedupe': event_deduper.stats,
+        'edits': edit_coalescer.stats,
+        'retention': retention.stats,
+        'socket': socket_receiver.stats,
+    }[name]()
+
+def handle_metrics_request(payload=None):
+    return metrics.render()
+
+def start_coordinator():
+    address = settings.get('coordinator_socket', '/tmp/slack-telegram-gate.sock')
+    authkey = os.urandom(16)
+    CoordinatorServer(address, authkey, {
+        'slack_event': handle_slack_event_request,
+        'telegram_update': handle_telegram_update_request,
+        'stats': handle_stats_request,
+        'metrics': handle_metrics_request,
+    }).start()
+
+    # Environment of the gunicorn workers
+    env = dict(os.environ)
+    env['GATE_IPC_ADDRESS'] = address
+    env['GATE_IPC_AUTHKEY'] = authkey.hex()
+    if settings.get('telegram_webhook_secret'):
+        env['GATE_TELEGRAM_WEBHOOK_SECRET'] = settings['telegram_webhook_secret']
+    if settings.get('slack_signing_secret'):
+        env['GATE_SLACK_SIGNING_SECRET'] = settings['slack_signing_secret']
+    return env
 
-app = Flask(__name__)
-# Route to receive events from Slack
-@app.route('/slack/events', methods=['POST'])
-def slack_event_handler():
+if __name__ == '__main__':
+    signal.signal(signal.SIGINT, signal_handler)
+
+    # Tokens are checked in the background, the bot member id of a project is also
+    # fetched on first use if its check has not finished yet
+    config = load_config(check_tokens=False)
     try:
-        data = request.json
-        
-        # Process challenge from Slack (during initial setup)
-        if 'challenge' in data:
-            return jsonify({'challenge': data['challenge']})
-        
-        # Immediately return the Slack response
-        if 'event' in data:
-            event_data = data['event']
-            threading.Thread(target=process_slack_event, args=(event_data,)).start()
-    except:
-        pass
-
-    return '', 200  
+        telegram_mode = get_telegram_mode(config['settings'])
+    except ValueError as e:
+        logging.critical(str(e))
+        print(f'Configuration error: {str(e)}')
+        sys.exit(1)
 
-if __name__ == '__main__':
-    # Event to stop threads
-    server_ip = get_server_ip()
-    print(f'http://{server_ip}:5555/slack/events')
-    logging.info(f"The server is running on {server_ip}. Use the URL for Slack Event Subscriptions: \nhttp://{server_ip}:5555/slack/events")
+    # Optional asyncio runtime: one event loop instead of gunicorn workers and threads
+    if config['settings'].get('runtime') == 'asyncio':
+        import async_gate
+        async_gate.run(config)
+        sys.exit(0)
+
+    init(config)
+
+    # This process owns the mapping store, config and outbound delivery,
+    # the gunicorn workers only pass events to it over a unix socket
+    worker_env = start_coordinator()
 
     # Run Gunicorn in a separate process
-    gunicorn_command = ["gunicorn", "-w", "4", "-b", "0.0.0.0:5555", "main:app"]
-    gunicorn_process = subprocess.Popen(gunicorn_command)
+    gunicorn_command = ["gunicorn", "-w", str(settings.get('http_workers', 4)), "-b", "0.0.0.0:5555", "ingress:app"]
+    gunicorn_process = subprocess.Popen(gunicorn_command, env=worker_env)
 
     # Run configuration monitoring in a separate thread
     monitor_thread = start_config_monitor(interval=60)
 
-    # Run Telegram bot in a separate thread
-    telegram_thread = threading.Thread(target=run_telegram_bot)
-    telegram_thread.start()
+    if telegram_mode == 'webhook':
+        # Telegram updates are received by the gunicorn workers and passed to the coordinator
+        threading.Thread(target=set_telegram_webhook, daemon=True).start()
+        telegram_thread = None
+    else:
+        # Run Telegram bot in a separate thread
+        telegram_thread = threading.Thread(target=run_telegram_bot)
+        telegram_thread.start()
+
+    startup_time = (time.monotonic() - startup_started) * 1000
+    print(f'Started in {startup_time:.0f} ms')
+    logging.info(f"Coordinator started in {startup_time:.0f} ms")
+
+    # The public URL is only printed, discovering it does not delay the startup
+    def print_public_url():
+        public_url = get_public_url(settings)
+        if public_url:
+            print(f'{public_url}/slack/events')
+            logging.info(f"The server is running. Use the URL for Slack Event Subscriptions: \n{public_url}/slack/events")
+    threading.Thread(target=print_public_url, daemon=True).start()
 
     # Wait for all threads to complete
-    telegram_thread.join()
+    if telegram_thread:
+        telegram_thread.join()
     monitor_thread.join()
 
     # Terminate the Gunicorn process
@@ -0,0 +1,118 @@
+import logging
+import tempfile
+import threading
+import metrics
+from telebot.types import InputMediaPhoto, InputMediaVideo
+
+CHUNK_SIZE = 256 * 1024
+
+class MediaTooLarge(Exception):
+    pass
+
+# Photos and videos of one Slack message are sent to Telegram as an album
+ALBUM_MIMETYPES = {
+    'image/jpeg': InputMediaPhoto,
+    'image/png': InputMediaPhoto,
+    'image/webp': InputMediaPhoto,
+    'video/mp4': InputMediaVideo,
+}
+ALBUM_MAX_SIZE = 10
+
+# Split the files of a Slack message into the parts sent to Telegram: albums of up to
+# ALBUM_MAX_SIZE photos and videos, then every other file on its own. A part of one
+# file is sent as a document, a single photo or video is not worth an album.
+# Files above max_size are left out before anything is downloaded.
+def group_slack_files(files, max_size=None):
+    if max_size:
+        too_large = [file for file in files if (file.get('size') or 0) > max_size]
+        for file in too_large:
+            logging.error(f"Slack file {file.get('name')} is too large to forward: {file['size']} bytes")
+        files = [file for file in files if file not in too_large]
+    album = [file for file in files if file.get('mimetype') in ALBUM_MIMETYPES]
+    documents = [file for file in files if file.get('mimetype') not in ALBUM_MIMETYPES]
+    parts = [album[start:start + ALBUM_MAX_SIZE] for start in range(0, len(album), ALBUM_MAX_SIZE)]
+    return parts + [[file] for file in documents]
+
+def file_part_id(part):
+    return ','.join(file.get('id') or file['url_private'] for file in part)
+
+# Limits the number of concurrent media transfers. Each transfer keeps at most
+# memory_limit bytes in RAM, larger files are spooled to a temporary file, so the
+# bytes held in memory never exceed max_concurrent * memory_limit.
+class MediaTransferLimiter:
+    def __init__(self, max_concurrent=4, memory_limit=1024 * 1024, max_size=50 * 1024 * 1024):
+        self.max_concurrent = max_concurrent
+        self.memory_limit = memory_limit
+        self.max_size = max_size
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.spooled = 0
+        self.rejected = 0
+
+    def __enter__(self):
+        self._slots.acquire()
+        with self._lock:
+            self.in_flight += 1
+        return self
+
+    def __exit__(self, *exc):
+        with self._lock:
+            self.in_flight -= 1
+        self._slots.release()
+
+# Stream a download into a SpooledTemporaryFile: kept in memory up to memory_limit,
+# written to disk in chunks above it. Raises MediaTooLarge above max_size.
+@metrics.stage_seconds.time(stage='media_download')
+def download_to_spool(session, url, limiter, headers=None, timeout=60):
+    with session.get(url, headers=headers, stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        content_length = int(response.headers.get('Content-Length') or 0)
+        if content_length > limiter.max_size:
+            limiter.rejected += 1
+            raise MediaTooLarge(f"File size {content_length} exceeds the limit of {limiter.max_size} bytes")
+
+        spool = tempfile.SpooledTemporaryFile(max_size=limiter.memory_limit)
+        size = 0
+        try:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                size += len(chunk)
+                if size > limiter.max_size:
+                    limiter.rejected += 1
+                    raise MediaTooLarge(f"File exceeds the limit of {limiter.max_size} bytes")
+                spool.write(chunk)
+        except Exception:
+            spool.close()
+            raise
+
+    if size > limiter.memory_limit:
+        limiter.spooled += 1
+    spool.seek(0)
+    return spool, size
+
+# Upload a spooled file to Slack. Small files go through files_upload_v2 from memory,
+# large ones are streamed from disk to the external upload URL, because files_upload_v2
+# reads the whole file into memory before sending it.
+def upload_spool_to_slack(slack_client, session, spool, size, limiter, channel, filename, title, initial_comment, thread_ts):
+    if size <= limiter.memory_limit:
+        slack_response = slack_client.files_upload_v2(
+            channel=channel,
+            file=spool.read(),
+            filename=filename,
+            title=title,
+            initial_comment=initial_comment,
+            thread_ts=thread_ts
+        )
+        return slack_response['file']['id']
+
+    upload = slack_client.files_getUploadURLExternal(filename=filename, length=size)
+    upload_response = session.post(upload['upload_url'], data=spool, headers={'Content-Length': str(size)}, timeout=300)
+    upload_response.raise_for_status()
+    slack_client.files_completeUploadExternal(
+        files=[{'id': upload['file_id'], 'title': title}],
+        channel_id=channel,
+        initial_comment=initial_comment,
+        thread_ts=thread_ts
+    )
+    logging.debug(f"File {filename} ({size} bytes) streamed to Slack from a temporary file")
+    return upload['file_id']
@@ -0,0 +1,149 @@
+import time
+import threading
+from contextlib import contextmanager
+
+# Process-wide metrics in the Prometheus text exposition format, without the
+# prometheus_client dependency. Counters and histograms are updated from any thread;
+# gauges are read from callbacks when the metrics are rendered.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+registry = []
+registry_lock = threading.Lock()
+
+def format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values)) + list(extra or [])
+    if not pairs:
+        return ''
+    escaped = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in pairs]
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        with registry_lock:
+            registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self._samples())
+        return lines
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            values = dict(self._values)
+        return [f'{self.name}{format_labels(self.labelnames, key)} {format_value(value)}' for key, value in sorted(values.items())]
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}   # label values -> [bucket counts, sum, count]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    # Observe the duration of a with block in seconds
+    @contextmanager
+    def time(self, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def _samples(self):
+        with self._lock:
+            values = {key: ([*entry[0]], entry[1], entry[2]) for key, entry in self._values.items()}
+        lines = []
+        for key, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{format_labels(self.labelnames, key, [("le", format_value(float(bound)))])} {cumulative}')
+            lines.append(f'{self.name}_bucket{format_labels(self.labelnames, key, [("le", "+Inf")])} {count}')
+            lines.append(f'{self.name}_sum{format_labels(self.labelnames, key)} {format_value(total)}')
+            lines.append(f'{self.name}_count{format_labels(self.labelnames, key)} {count}')
+        return lines
+
+# Gauge whose values are read from a callback per label set when rendered
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self._callbacks = {}
+
+    def set_function(self, func, **labels):
+        with self._lock:
+            self._callbacks[self._key(labels)] = func
+
+    def _samples(self):
+        with self._lock:
+            callbacks = dict(self._callbacks)
+        lines = []
+        for key, func in sorted(callbacks.items()):
+            try:
+                value = func()
+            except Exception:
+                continue
+            lines.append(f'{self.name}{format_labels(self.labelnames, key)} {format_value(value)}')
+        return lines
+
+def render():
+    with registry_lock:
+        metrics = list(registry)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Metrics of the gate
+messages_bridged = Counter('gate_messages_bridged_total', 'Messages bridged, by project, direction and content type', ['project', 'direction', 'content_type'])
+stage_seconds = Histogram('gate_stage_seconds', 'Time spent in each processing stage', ['stage'])
+api_calls = Histogram('gate_api_send_seconds', 'Duration of Telegram and Slack API calls, by rate limit bucket', ['api'])
+api_errors = Counter('gate_api_errors_total', 'Failed Telegram and Slack API calls', ['api'])
+api_rate_limited = Counter('gate_api_rate_limited_total', 'Telegram and Slack API calls answered with 429', ['api'])
+db_flush_seconds = Histogram('gate_db_flush_seconds', 'Duration of SQLite write-behind batch commits', buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5))
+db_write_queue = Gauge('gate_db_write_queue_depth', 'Writes queued for the SQLite writer')
+retention_deleted = Counter('gate_retention_deleted_total', 'Rows deleted by the retention policy', ['table'])
+in_flight = Gauge('gate_in_flight', 'Work currently in progress', ['kind'])
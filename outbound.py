@@ -0,0 +1,266 @@
+import time
+import heapq
+import random
+import socket
+import logging
+import threading
+import requests
+from urllib.error import URLError
+from urllib3.exceptions import NewConnectionError
+import metrics
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+from slack_sdk.errors import SlackApiError
+from dispatcher import TaskDeferred
+
+PRIORITY_MESSAGE = 0
+PRIORITY_EDIT = 1
+
+# Default limits as (requests per second, burst size), keyed by the first element of a
+# bucket key. Telegram allows about 30 messages per second overall and 20 per minute
+# in a group; Slack allows about one chat.postMessage per second per channel,
+# 50 per minute for Tier 3 methods (chat.update) and 20 per minute for Tier 2 (files).
+DEFAULT_RATE_LIMITS = {
+    'telegram': (30, 30),
+    'telegram_chat': (20 / 60, 20),
+    'slack_post': (1, 5),
+    'slack_update': (50 / 60, 10),
+    'slack_files': (20 / 60, 5),
+}
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+
+    # Seconds to wait until a token is available, after queued calls took theirs
+    def wait_time(self, now, queued=0):
+        if now < self.blocked_until:
+            return self.blocked_until - now + queued / self.rate
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        missing = queued + 1 - self.tokens
+        if missing <= 0:
+            return 0
+        return missing / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    # Stop sending through this bucket after a 429 / flood wait
+    def block(self, until):
+        self.blocked_until = max(self.blocked_until, until)
+        self.tokens = 0
+
+class OutboundJob:
+    def __init__(self, seq, keys, priority, func, args, kwargs):
+        self.seq = seq
+        self.keys = keys
+        self.priority = priority
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+        self.attempts = 0
+        self.not_before = 0
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+# Raised by OutboundScheduler.call instead of waiting longer than max_wait for a token,
+# the caller gives its thread back and tries again after retry_after seconds
+class RateLimitDeferred(TaskDeferred):
+    pass
+
+# Seconds the API asked us to wait, or None if the error is not a rate limit.
+# Telegram errors are matched by attributes, so the asyncio telebot exception works too.
+def get_retry_after(error):
+    if getattr(error, 'error_code', None) == 429 and hasattr(error, 'result_json'):
+        parameters = (error.result_json or {}).get('parameters') or {}
+        return float(parameters.get('retry_after', 1))
+    if isinstance(error, SlackApiError) and error.response.status_code == 429:
+        return float(error.response.headers.get('Retry-After', 1))
+    return None
+
+# Only errors raised before the request reached the API are retried. After a read timeout
+# or a dropped connection the message may already be posted, and a retry would post it twice.
+def is_transient_error(error):
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError):
+        reason = getattr(error.args[0], 'reason', None) if error.args else None
+        return isinstance(reason, NewConnectionError)
+    # slack_sdk calls go through urllib
+    if isinstance(error, URLError):
+        error = error.reason
+    return isinstance(error, (ConnectionRefusedError, socket.gaierror))
+
+# Outbound API call scheduler. Every call passes through the token buckets named by
+# its keys, e.g. [('telegram',), ('telegram_chat', chat_id)]. Fresh messages are sent
+# before edits, rate-limited calls are retried after Retry-After plus jitter.
+# Jobs with the same keys wait in one heap, so a dispatch only looks at the head of
+# each heap. call() raises RateLimitDeferred instead of holding its thread for more
+# than max_wait seconds.
+class OutboundScheduler:
+    def __init__(self, workers=8, rate_limits=None, max_attempts=5, max_wait=1.0):
+        self.rate_limits = dict(DEFAULT_RATE_LIMITS)
+        self.rate_limits.update(rate_limits or {})
+        self.max_attempts = max_attempts
+        self.max_wait = max_wait
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='outbound')
+        self._cond = threading.Condition()
+        self._queues = {}    # keys -> heap of jobs waiting for these buckets
+        self._delayed = []   # heap of (not_before, seq, job) of retried jobs
+        self._queued = Counter()   # bucket key -> jobs waiting for it
+        self._pending = 0
+        self._buckets = {}
+        self._seq = 0
+
+        self.sent = 0
+        self.retried = 0
+        self.rate_limited = 0
+        self.failed = 0
+        self.deferred = 0
+
+    def start(self):
+        threading.Thread(target=self._run, name='outbound-scheduler', daemon=True).start()
+        return self
+
+    def submit(self, keys, func, *args, priority=PRIORITY_MESSAGE, **kwargs):
+        with self._cond:
+            self._seq += 1
+            job = OutboundJob(self._seq, tuple(tuple(key) for key in keys), priority, func, args, kwargs)
+            self._push(job)
+            self._pending += 1
+            self._queued.update(job.keys)
+            self._cond.notify_all()
+        return job.future
+
+    # Submit a call and wait for its result. Raises RateLimitDeferred if the call would
+    # wait for a token longer than max_wait.
+    def call(self, keys, func, *args, priority=PRIORITY_MESSAGE, **kwargs):
+        self.defer_if_limited(keys, getattr(func, '__name__', func))
+        return self.submit(keys, func, *args, priority=priority, **kwargs).result()
+
+    # Raises RateLimitDeferred if a call through keys would wait longer than max_wait.
+    # Lets a task give up before expensive work, e.g. a download, whose result it could not send.
+    def defer_if_limited(self, keys, name):
+        if self.max_wait is None:
+            return
+        wait = self.wait_time(keys)
+        if wait > self.max_wait:
+            with self._cond:
+                self.deferred += 1
+            raise RateLimitDeferred(wait, f"{name} would wait {wait:.1f}s for a token")
+
+    # Seconds until a new call through keys could be sent
+    def wait_time(self, keys):
+        now = time.monotonic()
+        with self._cond:
+            return max([self._bucket(key).wait_time(now, self._queued[key]) for key in map(tuple, keys)], default=0)
+
+    def _push(self, job):
+        queue = self._queues.get(job.keys)
+        if queue is None:
+            queue = self._queues[job.keys] = []
+        heapq.heappush(queue, job)
+
+    def _bucket(self, key):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            rate, capacity = self.rate_limits[key[0]]
+            bucket = self._buckets[key] = TokenBucket(rate, capacity)
+        return bucket
+
+    # Find the first job (by priority and age) whose buckets all have a token. Jobs with
+    # the same keys share their buckets, so only the head of each queue is checked.
+    def _next_ready_job(self, now):
+        while self._delayed and self._delayed[0][0] <= now:
+            self._push(heapq.heappop(self._delayed)[2])
+
+        best = None
+        wake_at = self._delayed[0][0] if self._delayed else None
+        for keys, queue in self._queues.items():
+            wait = max([self._bucket(key).wait_time(now) for key in keys], default=0)
+            if wait <= 0:
+                if best is None or queue[0] < best[0]:
+                    best = queue[0], keys, queue
+            else:
+                wake_at = now + wait if wake_at is None else min(wake_at, now + wait)
+        if best is None:
+            return None, wake_at
+
+        job, keys, queue = best
+        for key in keys:
+            self._bucket(key).take()
+        heapq.heappop(queue)
+        if not queue:
+            del self._queues[keys]
+        self._pending -= 1
+        for key in keys:
+            self._queued[key] -= 1
+            if self._queued[key] <= 0:
+                del self._queued[key]
+        return job, None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                job, wake_at = self._next_ready_job(time.monotonic())
+                if job is None:
+                    self._cond.wait(None if wake_at is None else max(wake_at - time.monotonic(), 0.001))
+                    continue
+            self._executor.submit(self._execute, job)
+
+    def _execute(self, job):
+        job.attempts += 1
+        api = job.keys[0][0] if job.keys else 'other'
+        try:
+            with metrics.api_calls.time(api=api):
+                result = job.func(*job.args, **job.kwargs)
+        except Exception as e:
+            metrics.api_errors.inc(api=api)
+            retry_after = get_retry_after(e)
+            if retry_after is not None:
+                metrics.api_rate_limited.inc(api=api)
+                with self._cond:
+                    self.rate_limited += 1
+                    until = time.monotonic() + retry_after
+                    for key in job.keys:
+                        self._bucket(key).block(until)
+            elif is_transient_error(e):
+                retry_after = min(2 ** job.attempts, 60)
+
+            if retry_after is None or job.attempts >= self.max_attempts:
+                with self._cond:
+                    self.failed += 1
+                job.future.set_exception(e)
+                return
+
+            logging.warning(f"Outbound call {getattr(job.func, '__name__', job.func)} failed ({str(e)}), retry {job.attempts} in {retry_after:.1f}s")
+            with self._cond:
+                self.retried += 1
+                job.not_before = time.monotonic() + retry_after + random.uniform(0, retry_after * 0.1 + 0.5)
+                heapq.heappush(self._delayed, (job.not_before, job.seq, job))
+                self._pending += 1
+                self._queued.update(job.keys)
+                self._cond.notify_all()
+            return
+
+        with self._cond:
+            self.sent += 1
+        job.future.set_result(result)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'pending': self._pending,
+                'sent': self.sent,
+                'retried': self.retried,
+                'rate_limited': self.rate_limited,
+                'failed': self.failed,
+                'deferred': self.deferred,
+            }
@@ -0,0 +1,186 @@
+import json
+import time
+import random
+import logging
+import threading
+import storage
+from dispatcher import TaskDeferred
+
+# Durable outbox. Every bridged message is recorded in the outbox table before it is
+# delivered, keyed by an idempotency key built from the source message. Delivery is
+# tried at once in the calling thread; failed deliveries are retried by background
+# workers with exponential backoff, and unfinished ones are resumed after a restart.
+# A key that was already delivered (e.g. a redelivered Slack event) is never sent again.
+# A delivery deferred by rate limits stays pending and is not counted as an attempt.
+
+STATUS_PENDING = 'pending'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+INSERT_ENTRY = '''
+INSERT OR IGNORE INTO outbox (idempotency_key, kind, payload, status, attempts, next_attempt_at, created_at)
+VALUES (?, ?, ?, 'pending', 0, ?, ?)
+'''
+
+UPDATE_ENTRY = '''
+UPDATE outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ? WHERE idempotency_key = ?
+'''
+
+DEFER_ENTRY = 'UPDATE outbox SET next_attempt_at = ? WHERE idempotency_key = ?'
+
+class OutboxError(Exception):
+    pass
+
+class Outbox:
+    def __init__(self, db_path, writer, handlers, max_attempts=8, base_delay=2, max_delay=600, poll_interval=5, grace_period=60):
+        self.db_path = db_path
+        self.writer = writer
+        self.handlers = handlers
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self.grace_period = grace_period
+        self._claimed = set()
+        self._lock = threading.Lock()
+
+        self.delivered = 0
+        self.duplicates = 0
+        self.retries = 0
+        self.failed = 0
+        self.deferred = 0
+
+    def start(self, workers=1):
+        for i in range(workers):
+            threading.Thread(target=self._run, name=f'outbox-{i}', daemon=True).start()
+        return self
+
+    # Record an entry durably and deliver it in the calling thread.
+    # Returns False if the key was already delivered or is being delivered,
+    # raises OutboxError if the entry could not be stored and TaskDeferred if the
+    # delivery has to wait; the caller may then call deliver() again later.
+    def submit(self, key, kind, payload):
+        self.record(key, kind, payload)
+        return self.deliver(key)
+
+    # Store an entry without delivering it, raises OutboxError if it could not be stored
+    def record(self, key, kind, payload, attempts=3):
+        # Background workers leave a new entry to the caller for grace_period seconds,
+        # after that it is treated as left over by a crash
+        payload = json.dumps(payload, default=str)
+        for attempt in range(attempts):
+            now = time.time()
+            seq = self.writer.write(INSERT_ENTRY, (key, kind, payload, now + self.grace_period, now))
+            # INSERT OR IGNORE, so writing the entry again is harmless
+            if self.writer.flush(seq):
+                break
+            logging.warning(f"Outbox entry {key} was not stored, attempt {attempt + 1} of {attempts}")
+        else:
+            raise OutboxError(f"Outbox entry {key} could not be stored")
+
+    # Deliver a recorded entry in the calling thread, False if it was already delivered
+    # or is being delivered
+    def deliver(self, key):
+        entry = self._claim(key)
+        if entry is None:
+            self.duplicates += 1
+            logging.debug(f"Outbox entry {key} was already delivered, skipping")
+            return False
+        # A deferred entry is left to the caller for grace_period seconds more
+        self._deliver(entry, grace=self.grace_period)
+        return True
+
+    def _load(self, key):
+        cursor = storage.get_read_connection(self.db_path).cursor()
+        cursor.execute('SELECT idempotency_key, kind, payload, status, attempts FROM outbox WHERE idempotency_key = ?', (key,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return {'key': row[0], 'kind': row[1], 'payload': row[2], 'status': row[3], 'attempts': row[4]}
+
+    # Take the delivery of a pending entry, None if it is done or owned by another thread
+    def _claim(self, key):
+        with self._lock:
+            if key in self._claimed:
+                return None
+            self._claimed.add(key)
+        entry = self._load(key)
+        if entry is None or entry['status'] != STATUS_PENDING:
+            with self._lock:
+                self._claimed.discard(key)
+            # A missing entry was never stored, it must not pass for a delivered one
+            if entry is None:
+                raise OutboxError(f"Outbox entry {key} is missing")
+            return None
+        return entry
+
+    def _deliver(self, entry, grace=0):
+        key = entry['key']
+        attempts = entry['attempts'] + 1
+        try:
+            self.handlers[entry['kind']](json.loads(entry['payload']))
+        except TaskDeferred as e:
+            self.deferred += 1
+            seq = self.writer.write(DEFER_ENTRY, (time.time() + e.delay + grace, key))
+            self.writer.flush(seq)
+            with self._lock:
+                self._claimed.discard(key)
+            raise
+        except Exception as e:
+            if attempts >= self.max_attempts:
+                self.failed += 1
+                status, next_attempt_at = STATUS_FAILED, None
+                logging.error(f"Outbox entry {key} failed after {attempts} attempts: {str(e)}")
+            else:
+                self.retries += 1
+                delay = min(self.base_delay * 2 ** (attempts - 1), self.max_delay)
+                status, next_attempt_at = STATUS_PENDING, time.time() + delay * random.uniform(0.5, 1.0)
+                logging.warning(f"Outbox entry {key} failed ({str(e)}), retry {attempts} in about {delay}s")
+            seq = self.writer.write(UPDATE_ENTRY, (status, attempts, next_attempt_at, str(e), key))
+        else:
+            self.delivered += 1
+            seq = self.writer.write(UPDATE_ENTRY, (STATUS_DONE, attempts, None, None, key))
+
+        # The new status must be on disk before the entry can be claimed again
+        if not self.writer.flush(seq):
+            logging.error(f"Status of outbox entry {key} was not stored, it may be delivered again")
+        with self._lock:
+            self._claimed.discard(key)
+
+    # Pending entries whose retry time has come, including the ones left over by a restart
+    def _due_keys(self, limit=100):
+        cursor = storage.get_read_connection(self.db_path).cursor()
+        cursor.execute('''
+        SELECT idempotency_key FROM outbox
+        WHERE status = 'pending' AND next_attempt_at <= ?
+        ORDER BY next_attempt_at LIMIT ?
+        ''', (time.time(), limit))
+        return [row[0] for row in cursor.fetchall()]
+
+    def _run(self):
+        while True:
+            try:
+                for key in self._due_keys():
+                    entry = self._claim(key)
+                    if entry:
+                        try:
+                            self._deliver(entry)
+                        except TaskDeferred as e:
+                            logging.debug(f"Outbox entry {key} deferred: {str(e)}")
+            except Exception as e:
+                logging.error(f"Error draining the outbox: {str(e)}")
+            time.sleep(self.poll_interval)
+
+    def stats(self):
+        cursor = storage.get_read_connection(self.db_path).cursor()
+        cursor.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status")
+        counts = dict(cursor.fetchall())
+        return {
+            'pending': counts.get(STATUS_PENDING, 0),
+            'failed': counts.get(STATUS_FAILED, 0),
+            'delivered': self.delivered,
+            'duplicates': self.duplicates,
+            'retries': self.retries,
+            'failed_deliveries': self.failed,
+            'deferred': self.deferred,
+        }
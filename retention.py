@@ -0,0 +1,100 @@
+import time
+import logging
+import threading
+import storage
+import metrics
+
+# Retention of message mappings. A background thread deletes the mappings of each
+# project that are older than its retention_days, in small batches queued on the
+# write-behind writer, so regular writes keep flowing between the batches. Finished
+# outbox entries are aged out the same way, and the freed pages are returned to the
+# filesystem with incremental vacuum.
+
+DAY = 86400
+
+class RetentionWorker:
+    def __init__(self, mappings, policies, outbox_retention_days=7, interval=3600, batch_size=1000, pause=0.05, vacuum_pages=1000):
+        self.mappings = mappings
+        self.policies = policies
+        self.outbox_retention_days = outbox_retention_days
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+        self.vacuum_pages = vacuum_pages
+
+        self.runs = 0
+        self.deleted_mappings = 0
+        self.deleted_outbox = 0
+        self.last_run_duration = 0.0
+
+    def start(self):
+        threading.Thread(target=self._run, name='retention', daemon=True).start()
+        return self
+
+    def _run(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                logging.error(f"Error applying the retention policy: {str(e)}")
+            time.sleep(self.interval)
+
+    def run_once(self):
+        started = time.monotonic()
+        now = time.time()
+        for project_name, retention_days in self.policies():
+            cutoff = now - retention_days * DAY
+            store = self.mappings.store(project_name)
+            # Mappings saved in the shared database before per-project files were enabled
+            for target in {store, self.mappings.default}:
+                deleted = self._delete(
+                    target.db_path, target.writer, storage.DELETE_EXPIRED_MAPPINGS,
+                    'SELECT COUNT(*) FROM (SELECT 1 FROM message_threads WHERE project_name = ? AND created_at < ? LIMIT ?)',
+                    (project_name, cutoff)
+                )
+                if deleted:
+                    self.deleted_mappings += deleted
+                    metrics.retention_deleted.inc(deleted, table='message_threads')
+                    logging.info(f"Deleted {deleted} mappings older than {retention_days} days of the project {project_name}")
+
+        if self.outbox_retention_days:
+            default = self.mappings.default
+            deleted = self._delete(
+                default.db_path, default.writer, storage.DELETE_EXPIRED_OUTBOX,
+                "SELECT COUNT(*) FROM (SELECT 1 FROM outbox WHERE created_at < ? AND status != 'pending' LIMIT ?)",
+                (now - self.outbox_retention_days * DAY,)
+            )
+            if deleted:
+                self.deleted_outbox += deleted
+                metrics.retention_deleted.inc(deleted, table='outbox')
+
+        for store in self.mappings.stores():
+            store.flush()
+            storage.incremental_vacuum(store.db_path, self.vacuum_pages)
+
+        self.runs += 1
+        self.last_run_duration = time.monotonic() - started
+
+    # Queue batched deletes until no expired rows are left, returns the number of deleted rows
+    def _delete(self, db_path, writer, delete_query, count_query, params):
+        cursor = storage.get_read_connection(db_path).cursor()
+        deleted = 0
+        while True:
+            cursor.execute(count_query, params + (self.batch_size,))
+            count = cursor.fetchone()[0]
+            if not count:
+                return deleted
+            seq = writer.write(delete_query, params + (self.batch_size,))
+            if not writer.flush(seq, timeout=60):
+                logging.warning(f"Retention delete in {db_path} failed or was not committed in time, retrying on the next run")
+                return deleted
+            deleted += count
+            time.sleep(self.pause)
+
+    def stats(self):
+        return {
+            'runs': self.runs,
+            'deleted_mappings': self.deleted_mappings,
+            'deleted_outbox': self.deleted_outbox,
+            'last_run_duration': round(self.last_run_duration, 3),
+        }
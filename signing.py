@@ -0,0 +1,24 @@
+import hmac
+import time
+import hashlib
+
+# Slack request signing: https://api.slack.com/authentication/verifying-requests-from-slack
+# The signature is an HMAC-SHA256 of "v0:{timestamp}:{body}" keyed with the signing secret.
+
+SIGNATURE_VERSION = 'v0'
+
+def slack_signature(signing_secret, timestamp, body):
+    base = f'{SIGNATURE_VERSION}:{timestamp}:'.encode('utf-8') + body
+    digest = hmac.new(signing_secret.encode('utf-8'), base, hashlib.sha256).hexdigest()
+    return f'{SIGNATURE_VERSION}={digest}'
+
+# Check X-Slack-Signature of a request, old timestamps are rejected against replays
+def verify_slack_signature(signing_secret, timestamp, body, signature, max_age=300):
+    if not timestamp or not signature:
+        return False
+    try:
+        if abs(time.time() - int(timestamp)) > max_age:
+            return False
+    except ValueError:
+        return False
+    return hmac.compare_digest(slack_signature(signing_secret, timestamp, body), signature)
@@ -0,0 +1,72 @@
+import logging
+import threading
+from slack_sdk import WebClient
+from slack_sdk.socket_mode import SocketModeClient
+from slack_sdk.socket_mode.response import SocketModeResponse
+from ipc import EVENT_DROPPED
+
+# Slack Socket Mode ingestion. Projects with slack_ingestion: socket receive their
+# events over one persistent websocket per app token (slack_app_token) instead of
+# POST /slack/events, so the gate needs no public address. Events are passed on like
+# events received over HTTP and acknowledged once they are queued; an event dropped
+# by a full dispatcher is not acknowledged, so Slack delivers it again.
+
+def get_socket_mode_app_tokens(config):
+    return {
+        project['slack_app_token'] for project in config.get('channels') or []
+        if project.get('active', False) and project.get('slack_ingestion') == 'socket' and project.get('slack_app_token')
+    }
+
+class SocketModeReceiver:
+    def __init__(self, handle_event, slack_api_url=None):
+        self.handle_event = handle_event
+        self.slack_api_url = slack_api_url
+        self._clients = {}
+        self._lock = threading.Lock()
+
+        self.received = 0
+        self.failed = 0
+        self.dropped = 0
+
+    # Connect app tokens added to the config and close the ones no project uses any more
+    def sync(self, config):
+        tokens = get_socket_mode_app_tokens(config)
+        with self._lock:
+            for app_token in set(self._clients) - tokens:
+                self._clients.pop(app_token).close()
+                logging.info("Socket Mode connection closed, its app token is no longer used")
+            for app_token in tokens - set(self._clients):
+                try:
+                    self._clients[app_token] = self._connect(app_token)
+                except Exception as e:
+                    # Tried again on the next config reload
+                    logging.error(f"Error opening a Socket Mode connection: {str(e)}")
+
+    def _connect(self, app_token):
+        web_client = WebClient(base_url=self.slack_api_url) if self.slack_api_url else WebClient()
+        client = SocketModeClient(app_token=app_token, web_client=web_client)
+        client.socket_mode_request_listeners.append(self._on_request)
+        client.connect()
+        logging.info("Socket Mode connection opened")
+        return client
+
+    def _on_request(self, client, request):
+        if request.type == 'events_api' and 'event' in request.payload:
+            self.received += 1
+            try:
+                result = self.handle_event({'event_id': request.payload.get('event_id'), 'event': request.payload['event']})
+            except Exception as e:
+                self.failed += 1
+                logging.error(f"Error handling a Socket Mode event: {str(e)}")
+                result = None
+            if result == EVENT_DROPPED:
+                # Slack redelivers envelopes that are not acknowledged within 3 seconds
+                self.dropped += 1
+                logging.error(f"Socket Mode event {request.payload.get('event_id')} dropped, left unacknowledged for redelivery")
+                return
+        client.send_socket_mode_response(SocketModeResponse(envelope_id=request.envelope_id))
+
+    def stats(self):
+        with self._lock:
+            connections = len(self._clients)
+        return {'connections': connections, 'received': self.received, 'failed': self.failed, 'dropped': self.dropped}
@@ -0,0 +1,523 @@
+import os
+import re
+import time
+import logging
+import sqlite3
+import threading
+import metrics
+from collections import OrderedDict, deque
+
+# Open a SQLite connection tuned for one writer and many concurrent readers
+def connect(db_path):
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+# Each thread gets its own read connection, WAL lets them read while the writer commits
+_readers = threading.local()
+
+def get_read_connection(db_path):
+    connections = getattr(_readers, 'connections', None)
+    if connections is None:
+        connections = _readers.connections = {}
+    conn = connections.get(db_path)
+    if conn is None:
+        conn = connections[db_path] = connect(db_path)
+    return conn
+
+# Write-behind engine: writes are queued and committed in groups by a single thread.
+# A group is flushed when it reaches batch_size, when the oldest write is older than
+# max_delay seconds, or when a reader asks for it with flush(). When a group fails,
+# its writes are retried one by one, so one bad write does not take the others down.
+class WriteBehindWriter:
+    def __init__(self, db_path, batch_size=200, max_delay=0.05, on_commit=None):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.on_commit = on_commit
+
+        self._cond = threading.Condition()
+        self._pending = []
+        self._first_pending_time = None
+        self._flush_requested = False
+        self._last_seq = 0
+        self._committed_seq = 0   # every write up to it is committed or failed
+        self._failed = deque(maxlen=10000)   # sequence numbers of failed writes
+        self._thread = None
+
+        self.flushes = 0
+        self.rows_written = 0
+        self.errors = 0
+        self.last_flush_duration = 0.0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='sqlite-writer', daemon=True)
+        self._thread.start()
+        return self
+
+    # Queue a write and return its sequence number
+    def write(self, query, params):
+        with self._cond:
+            self._last_seq += 1
+            if not self._pending:
+                self._first_pending_time = time.monotonic()
+            self._pending.append((self._last_seq, query, params))
+            if len(self._pending) == 1 or len(self._pending) >= self.batch_size:
+                self._cond.notify_all()
+            return self._last_seq
+
+    # Commit everything up to seq (all queued writes by default). Returns False on timeout
+    # and when the write seq (or one of the queued writes) failed.
+    def flush(self, seq=None, timeout=5):
+        with self._cond:
+            if seq is None:
+                seq = self._last_seq
+                lowest = self._committed_seq + 1
+            else:
+                lowest = seq
+            if self._committed_seq < seq:
+                self._flush_requested = True
+                self._cond.notify_all()
+                if not self._cond.wait_for(lambda: self._committed_seq >= seq, timeout):
+                    return False
+            return not any(lowest <= failed <= seq for failed in self._failed)
+
+    def queue_depth(self):
+        with self._cond:
+            return len(self._pending)
+
+    def _take_batch(self):
+        with self._cond:
+            while True:
+                if self._pending:
+                    if self._flush_requested or len(self._pending) >= self.batch_size:
+                        break
+                    remaining = self._first_pending_time + self.max_delay - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                else:
+                    self._cond.wait()
+            batch = self._pending[:self.batch_size]
+            del self._pending[:self.batch_size]
+            self._first_pending_time = time.monotonic() if self._pending else None
+            if not self._pending:
+                self._flush_requested = False
+            return batch
+
+    def _execute_batch(self, conn, batch):
+        # Consecutive writes with the same query are sent with one executemany call
+        with conn:
+            start = 0
+            while start < len(batch):
+                query = batch[start][1]
+                end = start
+                while end < len(batch) and batch[end][1] == query:
+                    end += 1
+                conn.executemany(query, [params for _, _, params in batch[start:end]])
+                start = end
+
+    # Returns the writes that could not be committed
+    def _execute_one_by_one(self, conn, batch):
+        failed = []
+        for entry in batch:
+            try:
+                with conn:
+                    conn.execute(entry[1], entry[2])
+            except sqlite3.Error as e:
+                self.errors += 1
+                failed.append(entry)
+                logging.error(f"Error executing queued write, it is not stored: {e}")
+        return failed
+
+    def _run(self):
+        conn = connect(self.db_path)
+        while True:
+            batch = self._take_batch()
+            started = time.monotonic()
+            try:
+                self._execute_batch(conn, batch)
+                failed = []
+            except sqlite3.Error as e:
+                # The whole group was rolled back
+                logging.warning(f"Error committing {len(batch)} queued writes, retrying them one by one: {e}")
+                failed = self._execute_one_by_one(conn, batch)
+            failed_seqs = {seq for seq, _, _ in failed}
+            committed = [entry for entry in batch if entry[0] not in failed_seqs]
+            self.rows_written += len(committed)
+            logging.debug(f"Committed {len(committed)} queued writes")
+            self.last_flush_duration = time.monotonic() - started
+            metrics.db_flush_seconds.observe(self.last_flush_duration)
+            self.flushes += 1
+
+            # Only committed writes are reported
+            if self.on_commit and committed:
+                try:
+                    self.on_commit([(query, params) for _, query, params in committed])
+                except Exception as e:
+                    logging.error(f"Error in commit callback: {str(e)}")
+
+            with self._cond:
+                self._failed.extend(sorted(failed_seqs))
+                self._committed_seq = batch[-1][0]
+                self._cond.notify_all()
+
+
+# Thread-safe bounded LRU cache
+class LRUCache:
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, overwrite=True):
+        with self._lock:
+            if not overwrite and key in self._items:
+                self._items.move_to_end(key)
+                return
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def pop(self, key, value=None):
+        # Remove key, only if it still holds value when value is given
+        with self._lock:
+            if value is None or self._items.get(key) == value:
+                self._items.pop(key, None)
+
+    def __len__(self):
+        return len(self._items)
+
+INSERT_MAPPING = '''
+INSERT OR REPLACE INTO message_threads (telegram_message_id, slack_thread_ts, project_name, created_at)
+VALUES (?, ?, ?, ?)
+'''
+
+# Schema migrations, applied in order and tracked with PRAGMA user_version
+MIGRATIONS = [
+    '''
+    CREATE TABLE IF NOT EXISTS message_threads (
+        telegram_message_id INTEGER,
+        slack_thread_ts TEXT,
+        project_name TEXT,
+        PRIMARY KEY (telegram_message_id, project_name)
+    )
+    ''',
+    '''
+    CREATE INDEX IF NOT EXISTS idx_message_threads_slack_ts
+    ON message_threads (project_name, slack_thread_ts)
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        idempotency_key TEXT NOT NULL UNIQUE,
+        kind TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        status TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at REAL,
+        last_error TEXT,
+        created_at REAL NOT NULL
+    )
+    ''',
+    '''
+    CREATE INDEX IF NOT EXISTS idx_outbox_due
+    ON outbox (status, next_attempt_at)
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS seen_events (
+        event_key TEXT PRIMARY KEY,
+        seen_at REAL NOT NULL
+    ) WITHOUT ROWID
+    ''',
+    '''
+    ALTER TABLE message_threads ADD COLUMN created_at REAL
+    ''',
+    # Mappings saved before timestamps were stored age from the upgrade
+    '''
+    UPDATE message_threads SET created_at = CAST(strftime('%s', 'now') AS REAL) WHERE created_at IS NULL
+    ''',
+    '''
+    CREATE INDEX IF NOT EXISTS idx_message_threads_created_at
+    ON message_threads (project_name, created_at)
+    ''',
+    '''
+    CREATE INDEX IF NOT EXISTS idx_outbox_created_at
+    ON outbox (created_at)
+    ''',
+]
+
+AUTO_VACUUM_INCREMENTAL = 2
+
+def migrate(db_path):
+    conn = connect(db_path)
+    try:
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        # Pages freed by retention are returned to the filesystem with incremental_vacuum.
+        # The mode only changes with a full VACUUM, which runs once per database.
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != AUTO_VACUUM_INCREMENTAL:
+            logging.info(f"Enabling incremental vacuum for {db_path}")
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.execute('VACUUM')
+        for number, statement in enumerate(MIGRATIONS[version:], start=version + 1):
+            with conn:
+                conn.execute(statement)
+                conn.execute(f'PRAGMA user_version = {number}')
+            logging.info(f"Database {db_path} migrated to schema version {number}")
+    finally:
+        conn.close()
+
+# Bidirectional Telegram message_id <-> Slack ts mapping store.
+# Writes go through the write-behind writer and are visible at once through the
+# pending maps (until committed) and the LRU caches (filled on write).
+# Several Telegram messages can share one Slack ts (thread replies, file uploads),
+# the Slack ts -> Telegram direction resolves to the first saved message.
+class MappingStore:
+    def __init__(self, db_path, cache_size=10000, batch_size=200, max_delay=0.05):
+        self.db_path = db_path
+        migrate(db_path)
+        self.writer = WriteBehindWriter(db_path, batch_size, max_delay, on_commit=self._release_pending)
+        self._cond = threading.Condition()
+        self._pending_by_ts = {}
+        self._pending_by_message = {}
+        self.by_ts = LRUCache(cache_size)
+        self.by_message = LRUCache(cache_size)
+
+    def start(self):
+        self.writer.start()
+        return self
+
+    def save(self, telegram_message_id, slack_thread_ts, project_name):
+        message_key = (project_name, telegram_message_id)
+        ts_key = (project_name, slack_thread_ts)
+        with self._cond:
+            previous_ts = self.by_message.get(message_key)
+            if previous_ts is not None and previous_ts != slack_thread_ts:
+                self.by_ts.pop((project_name, previous_ts), telegram_message_id)
+            self._pending_by_message[message_key] = slack_thread_ts
+            self._pending_by_ts.setdefault(ts_key, telegram_message_id)
+            self.by_message.put(message_key, slack_thread_ts)
+            self.by_ts.put(ts_key, telegram_message_id, overwrite=False)
+            self._cond.notify_all()
+        return self.writer.write(INSERT_MAPPING, (telegram_message_id, slack_thread_ts, project_name, time.time()))
+
+    def get_slack_thread_ts(self, telegram_message_id, project_name):
+        key = (project_name, telegram_message_id)
+        slack_thread_ts = self._pending_by_message.get(key) or self.by_message.get(key)
+        if slack_thread_ts is not None:
+            return slack_thread_ts
+        cursor = get_read_connection(self.db_path).cursor()
+        cursor.execute('SELECT slack_thread_ts FROM message_threads WHERE telegram_message_id = ? AND project_name = ?', (telegram_message_id, project_name))
+        result = cursor.fetchone()
+        if result:
+            self.by_message.put(key, result[0])
+            return result[0]
+        return None
+
+    def get_telegram_message_id(self, slack_thread_ts, project_name):
+        key = (project_name, slack_thread_ts)
+        telegram_message_id = self._pending_by_ts.get(key) or self.by_ts.get(key)
+        if telegram_message_id is not None:
+            return telegram_message_id
+        cursor = get_read_connection(self.db_path).cursor()
+        cursor.execute('SELECT telegram_message_id FROM message_threads WHERE project_name = ? AND slack_thread_ts = ? ORDER BY telegram_message_id LIMIT 1', (project_name, slack_thread_ts))
+        result = cursor.fetchone()
+        if result:
+            self.by_ts.put(key, result[0], overwrite=False)
+            return result[0]
+        return None
+
+    # Wait for a Slack ts -> Telegram mapping saved by another thread
+    def wait_for_telegram_message_id(self, slack_thread_ts, project_name, timeout):
+        key = (project_name, slack_thread_ts)
+        with self._cond:
+            # A mapping missing from the pending map is either committed or not saved yet
+            telegram_message_id = self.get_telegram_message_id(slack_thread_ts, project_name)
+            if telegram_message_id is not None:
+                return telegram_message_id
+            # save() fills by_ts too, so a mapping committed before this thread wakes up is not missed
+            if self._cond.wait_for(lambda: key in self._pending_by_ts or self.by_ts.get(key) is not None, timeout):
+                return self._pending_by_ts.get(key) or self.by_ts.get(key)
+        return None
+
+    def flush(self, seq=None, timeout=5):
+        return self.writer.flush(seq, timeout)
+
+    # Drop committed mappings from the pending maps unless they were overwritten meanwhile
+    def _release_pending(self, writes):
+        with self._cond:
+            for query, params in writes:
+                if query != INSERT_MAPPING:
+                    continue
+                telegram_message_id, slack_thread_ts, project_name, _ = params
+                key = (project_name, slack_thread_ts)
+                if self._pending_by_ts.get(key) == telegram_message_id:
+                    del self._pending_by_ts[key]
+                key = (project_name, telegram_message_id)
+                if self._pending_by_message.get(key) == slack_thread_ts:
+                    del self._pending_by_message[key]
+
+# Mapping stores of all projects. By default every project shares db_path; with
+# per_project=True each project gets its own database file next to it, so a busy
+# project does not slow down the lookups and writes of the others. Mappings saved in
+# the shared file before the switch are still found there.
+class PartitionedMappingStore:
+    def __init__(self, db_path, per_project=False, **options):
+        self.db_path = db_path
+        self.per_project = per_project
+        self.options = options
+        self.default = MappingStore(db_path, **options)
+        self._stores = {}
+        self._lock = threading.Lock()
+
+    # The writer of the shared database, also used by the outbox and the deduper
+    @property
+    def writer(self):
+        return self.default.writer
+
+    def start(self):
+        self.default.start()
+        return self
+
+    def project_db_path(self, project_name):
+        root, ext = os.path.splitext(self.db_path)
+        return f"{root}-{re.sub(r'[^A-Za-z0-9_.-]', '_', project_name)}{ext}"
+
+    def store(self, project_name):
+        if not self.per_project:
+            return self.default
+        store = self._stores.get(project_name)
+        if store is None:
+            with self._lock:
+                store = self._stores.get(project_name)
+                if store is None:
+                    store = self._stores[project_name] = MappingStore(self.project_db_path(project_name), **self.options).start()
+        return store
+
+    def stores(self):
+        with self._lock:
+            return [self.default] + list(self._stores.values())
+
+    def save(self, telegram_message_id, slack_thread_ts, project_name):
+        return self.store(project_name).save(telegram_message_id, slack_thread_ts, project_name)
+
+    def get_slack_thread_ts(self, telegram_message_id, project_name):
+        store = self.store(project_name)
+        result = store.get_slack_thread_ts(telegram_message_id, project_name)
+        if result is None and store is not self.default:
+            result = self.default.get_slack_thread_ts(telegram_message_id, project_name)
+        return result
+
+    def get_telegram_message_id(self, slack_thread_ts, project_name):
+        store = self.store(project_name)
+        result = store.get_telegram_message_id(slack_thread_ts, project_name)
+        if result is None and store is not self.default:
+            result = self.default.get_telegram_message_id(slack_thread_ts, project_name)
+        return result
+
+    def wait_for_telegram_message_id(self, slack_thread_ts, project_name, timeout):
+        return self.store(project_name).wait_for_telegram_message_id(slack_thread_ts, project_name, timeout)
+
+    # Commit the queued writes of all databases
+    def flush(self, timeout=5):
+        return all([store.flush(None, timeout) for store in self.stores()])
+
+# Batched deletes of the retention worker, each one a short transaction of the writer
+DELETE_EXPIRED_MAPPINGS = '''
+DELETE FROM message_threads WHERE rowid IN (
+    SELECT rowid FROM message_threads WHERE project_name = ? AND created_at < ? LIMIT ?
+)
+'''
+DELETE_EXPIRED_OUTBOX = '''
+DELETE FROM outbox WHERE id IN (
+    SELECT id FROM outbox WHERE created_at < ? AND status != 'pending' LIMIT ?
+)
+'''
+
+# Return up to pages free pages to the filesystem, returns the number of pages left free
+def incremental_vacuum(db_path, pages=1000):
+    conn = connect(db_path)
+    try:
+        # Every step of the pragma frees one page, executescript runs it to the end
+        conn.executescript(f'PRAGMA incremental_vacuum({int(pages)});')
+        return conn.execute('PRAGMA freelist_count').fetchone()[0]
+    finally:
+        conn.close()
+
+INSERT_SEEN_EVENT = 'INSERT OR IGNORE INTO seen_events (event_key, seen_at) VALUES (?, ?)'
+DELETE_SEEN_EVENTS = 'DELETE FROM seen_events WHERE seen_at < ?'
+DELETE_SEEN_EVENT = 'DELETE FROM seen_events WHERE event_key = ?'
+
+# Deduplication of incoming Slack events by event_id and by (channel, ts).
+# Recent keys are answered from a bounded in-memory window, older ones from the
+# seen_events table, so retries are also caught after a restart.
+class EventDeduper:
+    def __init__(self, db_path, writer, window=10000, retention=86400):
+        self.db_path = db_path
+        self.writer = writer
+        self.retention = retention
+        self._recent = LRUCache(window)
+        self._lock = threading.Lock()
+        self._last_cleanup = 0
+        self.duplicates = 0
+
+    def _keys(self, event_id, channel, ts):
+        keys = []
+        if event_id:
+            keys.append(f'id:{event_id}')
+        if channel and ts:
+            keys.append(f'ts:{channel}:{ts}')
+        return keys
+
+    # Returns True for a new event and remembers it, False for a duplicate
+    def check_and_mark(self, event_id, channel=None, ts=None):
+        keys = self._keys(event_id, channel, ts)
+        if not keys:
+            return True
+
+        with self._lock:
+            if any(self._recent.get(key) for key in keys) or self._seen_on_disk(keys):
+                self.duplicates += 1
+                for key in keys:
+                    self._recent.put(key, True)
+                return False
+
+            now = time.time()
+            for key in keys:
+                self._recent.put(key, True)
+                self.writer.write(INSERT_SEEN_EVENT, (key, now))
+            if now - self._last_cleanup > 3600:
+                self._last_cleanup = now
+                self.writer.write(DELETE_SEEN_EVENTS, (now - self.retention,))
+            return True
+
+    # Forget an event that was marked but could not be processed
+    def unmark(self, event_id, channel=None, ts=None):
+        with self._lock:
+            for key in self._keys(event_id, channel, ts):
+                self._recent.pop(key)
+                self.writer.write(DELETE_SEEN_EVENT, (key,))
+
+    def _seen_on_disk(self, keys):
+        cursor = get_read_connection(self.db_path).cursor()
+        cursor.execute(
+            f'SELECT 1 FROM seen_events WHERE event_key IN ({",".join("?" * len(keys))}) LIMIT 1', keys
+        )
+        return cursor.fetchone() is not None
+
+    def stats(self):
+        return {'window': len(self._recent), 'duplicates': self.duplicates}
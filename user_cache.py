@@ -0,0 +1,111 @@
+import time
+import logging
+import threading
+from slack_sdk.errors import SlackApiError
+
+# Display name of a Slack user as shown in bridged messages
+def get_display_name(user):
+    return user.get('real_name') or user.get('name')
+
+# Per-workspace cache of Slack user display names with a TTL.
+# Concurrent misses for the same user wait for one users.info call.
+class SlackUserCache:
+    def __init__(self, ttl=3600, max_size=50000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = {}      # (workspace, user_id) -> (name, expires_at)
+        self._inflight = {}     # (workspace, user_id) -> threading.Event
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _put(self, key, name, now):
+        if len(self._entries) >= self.max_size and key not in self._entries:
+            # Evict expired entries first, then the ones closest to expiry
+            expired = [k for k, (_, expires_at) in self._entries.items() if expires_at <= now]
+            for k in expired or sorted(self._entries, key=lambda k: self._entries[k][1])[:self.max_size // 10 or 1]:
+                del self._entries[k]
+        self._entries[key] = (name, now + self.ttl)
+
+    # Cached name without fetching, None on a miss
+    def peek(self, workspace, user_id):
+        with self._lock:
+            entry = self._entries.get((workspace, user_id))
+            if entry and entry[1] > time.monotonic():
+                self.hits += 1
+                return entry[0]
+        return None
+
+    # Return the cached name or call fetch(user_id) once for all concurrent callers.
+    # fetch returns a name or None, None results are not cached.
+    def get(self, workspace, user_id, fetch):
+        key = (workspace, user_id)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                entry = self._entries.get(key)
+                if entry and entry[1] > now:
+                    self.hits += 1
+                    return entry[0]
+                inflight = self._inflight.get(key)
+                if inflight is None:
+                    self.misses += 1
+                    inflight = self._inflight[key] = threading.Event()
+                    break
+            # Another thread fetches this user, wait for its result
+            inflight.wait()
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry:
+                    self.hits += 1
+                    return entry[0]
+            if key not in self._inflight:
+                return None
+
+        name = None
+        try:
+            name = fetch(user_id)
+        finally:
+            with self._lock:
+                if name is not None:
+                    self._put(key, name, time.monotonic())
+                del self._inflight[key]
+            inflight.set()
+        return name
+
+    # Warm the cache with all users of a workspace (paginated users.list)
+    def preload(self, workspace, slack_client, page_size=200):
+        cursor = None
+        loaded = 0
+        try:
+            while True:
+                response = slack_client.users_list(limit=page_size, cursor=cursor)
+                now = time.monotonic()
+                with self._lock:
+                    for user in response['members']:
+                        name = get_display_name(user)
+                        if name:
+                            self._put((workspace, user['id']), name, now)
+                            loaded += 1
+                cursor = (response.get('response_metadata') or {}).get('next_cursor')
+                if not cursor:
+                    break
+            logging.debug(f"Preloaded {loaded} Slack users into the cache")
+        except SlackApiError as e:
+            logging.error(f"Error preloading Slack users: {e.response['error']}")
+        return loaded
+
+    # Drop a user from all workspaces (user_change events carry no workspace token)
+    def invalidate(self, user_id):
+        with self._lock:
+            for key in [k for k in self._entries if k[1] == user_id]:
+                del self._entries[key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'ttl': self.ttl,
+            }
@@ -1,55 +1,69 @@
 import os
 import yaml
+import shutil
+import tempfile
 import time
 import logging
-import sqlite3
 import requests
 import threading
-from queue import Queue
-from threading import Event
+import storage
+from retention import RetentionWorker
+import metrics
+from user_cache import SlackUserCache, get_display_name
+from types import MappingProxyType
+from collections import namedtuple
+from requests.adapters import HTTPAdapter
 from slack_sdk import WebClient
 from slack_sdk.errors import SlackApiError
+from concurrent.futures import ThreadPoolExecutor, wait
 
-query_queue = Queue()
-queue_processed_event = Event()
-queue_processed_event.set()  
+# Filesystem notifications for config.yaml are optional, polling is used without watchdog
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+
+DB_PATH = 'messages.db'
+CONFIG_PATH = 'config.yaml'
 config_last_loaded_time = 0  
 
-def worker():
-    global query_queue, queue_processed_event
-    while True:
-        time.sleep(3)  
-        if not query_queue.empty():
-            queue_processed_event.clear()  
-            while not query_queue.empty():
-                try:
-                    query, params = query_queue.get(timeout=1)
-                    cursor.execute(query, params)
-                    conn.commit()
-                    logging.debug(f"The request was completed with parameters: {params}")
-                    query_queue.task_done()
-                    
-                except sqlite3.Error as e:
-                    logging.error(f"Error executing request: {e}")
-            queue_processed_event.set()  
-
-threading.Thread(target=worker, daemon=True).start()
-lock = threading.Lock()
-
-conn = sqlite3.connect('messages.db', check_same_thread=False)
-cursor = conn.cursor()
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS message_threads (
-    telegram_message_id INTEGER,
-    slack_thread_ts TEXT,
-    project_name TEXT,
-    PRIMARY KEY (telegram_message_id, project_name)
-)
-''')
-conn.commit()
-conn.close
+# Telegram message_id <-> Slack ts mapping store with an in-memory LRU front,
+# opened by init_storage() so that importing utils does not touch the database
+mapping_store = None
+
+def init_storage(per_project=False):
+    global mapping_store
+    if mapping_store is None:
+        mapping_store = storage.PartitionedMappingStore(DB_PATH, per_project=per_project).start()
+    return mapping_store
+
+# Ask the writers to commit all queued mappings
+def flush_mappings(timeout=5):
+    return mapping_store.flush(timeout)
+
+# Retention in days of each project that has one, retention_days of a project
+# overrides the one in settings
+def get_retention_policies():
+    config = current_routes.config
+    default_days = (config.get('settings') or {}).get('retention_days')
+    policies = []
+    for project in config.get('channels') or []:
+        retention_days = project.get('retention_days', default_days)
+        if retention_days:
+            policies.append((project['project_name'], retention_days))
+    return policies
+
+def init_retention(settings):
+    return RetentionWorker(
+        mapping_store, get_retention_policies,
+        outbox_retention_days=settings.get('outbox_retention_days', 7),
+        interval=settings.get('retention_interval', 3600),
+        batch_size=settings.get('retention_batch_size', 1000)
+    ).start()
 
 # Reply to slack from telegram
+@metrics.stage_seconds.time(stage='mapping_lookup')
 def process_reply_message(message, project):
     thread_ts = None
     if message.reply_to_message:
@@ -61,59 +75,166 @@ def process_reply_message(message, project):
             logging.warning(f"thread_ts not found for message with message_id={message.reply_to_message.message_id}")
     return thread_ts
 
+# Routing indexes built once per config load and published with a single reference swap
+Routes = namedtuple('Routes', ['config', 'by_slack_channel', 'by_chat_id'])
+current_routes = Routes({'settings': {}, 'channels': []}, MappingProxyType({}), MappingProxyType({}))
+
+def build_routes(config):
+    by_slack_channel = {}
+    by_chat_id = {}
+    for project in config.get('channels') or []:
+        by_slack_channel.setdefault(project['slack_channel_id'], project)
+        by_chat_id.setdefault(str(project['telegram_chat_id']), project)
+    return Routes(config, MappingProxyType(by_slack_channel), MappingProxyType(by_chat_id))
+
 # Search for a project by Slack channel
 def find_project_by_slack_channel(channel_id):
-    logging.debug(f"Search for a project for Slack channel_id={channel_id}")
-    for project in current_config['channels']:
-        if project['slack_channel_id'] == channel_id:
-            logging.debug(f"Project found: {project['project_name']}")
-            return project
-    logging.warning(f"Project not found for Slack channel_id={channel_id}")
-    return None
+    project = current_routes.by_slack_channel.get(channel_id)
+    if project is None:
+        logging.warning(f"Project not found for Slack channel_id={channel_id}")
+    return project
 
 # Search for a project by Telegram chat_id
 def find_project_by_chat_id(chat_id):
-    logging.debug(f"Search for a project for chat_id={chat_id}")
-    for project in current_config['channels']:
-        if project['telegram_chat_id'] == str(chat_id):
-            logging.debug(f"Project found: {project['project_name']}")
-            return project
-    logging.warning(f"Project not found for chat_id={chat_id}")
-    return None
+    project = current_routes.by_chat_id.get(str(chat_id))
+    if project is None:
+        logging.warning(f"Project not found for chat_id={chat_id}")
+    return project
 
 # Getting thread_ts from the database by message_id
 def get_thread_ts_from_slack(telegram_message_id, project_name):
-    cursor.execute('SELECT slack_thread_ts FROM message_threads WHERE telegram_message_id = ? AND project_name = ?', (telegram_message_id, project_name))
-    result = cursor.fetchone()
-    if result:
-        return result[0]  
-    return None
+    return mapping_store.get_slack_thread_ts(telegram_message_id, project_name)
+
+# Slack WebClient per bot token, shared by all threads. A client is created on first
+# use of a token and dropped when no project uses that token after a config reload.
+slack_clients = {}
+slack_clients_lock = threading.Lock()
+
+def get_slack_client(slack_bot_token):
+    slack_client = slack_clients.get(slack_bot_token)
+    if slack_client is None:
+        with slack_clients_lock:
+            slack_client = slack_clients.get(slack_bot_token)
+            if slack_client is None:
+                base_url = get_slack_api_url(current_routes.config.get('settings') or {})
+                slack_client = slack_clients[slack_bot_token] = WebClient(token=slack_bot_token, base_url=base_url)
+    return slack_client
+
+# API base URLs, telegram_api_url and slack_api_url point the gate to other servers,
+# e.g. the local stand-ins of bench/
+def get_telegram_api_url(settings):
+    return (settings.get('telegram_api_url') or 'https://api.telegram.org').rstrip('/')
+
+def get_slack_api_url(settings):
+    return (settings.get('slack_api_url') or 'https://slack.com/api/').rstrip('/') + '/'
+
+# Telegram mode, polling or webhook. Webhook updates are only accepted with telegram_webhook_secret,
+# so webhook mode does not start without it.
+def get_telegram_mode(settings):
+    telegram_mode = settings.get('telegram_mode', 'polling')
+    if telegram_mode == 'webhook' and not settings.get('telegram_webhook_secret'):
+        raise ValueError("telegram_mode: webhook requires telegram_webhook_secret")
+    return telegram_mode
+
+def prune_slack_clients(config):
+    tokens = {project['slack_bot_token'] for project in config.get('channels') or []}
+    with slack_clients_lock:
+        for slack_bot_token in list(slack_clients):
+            if slack_bot_token not in tokens:
+                del slack_clients[slack_bot_token]
+
+# Pooled keep-alive HTTP sessions for file transfers, one per remote service
+http_sessions = {}
+http_sessions_lock = threading.Lock()
+
+def get_http_session(service):
+    session = http_sessions.get(service)
+    if session is None:
+        with http_sessions_lock:
+            session = http_sessions.get(service)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                http_sessions[service] = session
+    return session
+
+# Slack bot member IDs by bot token, so auth.test runs once per token
+bot_member_ids = {}
 
 # Getting Slack bot member ID
 def get_slack_bot_member_id(slack_bot_token):
+    if slack_bot_token in bot_member_ids:
+        return bot_member_ids[slack_bot_token]
     try:
-        slack_client = WebClient(token=slack_bot_token)
+        slack_client = get_slack_client(slack_bot_token)
         response = slack_client.auth_test()  
         slack_bot_member_id = response['user_id']
+        bot_member_ids[slack_bot_token] = slack_bot_member_id
         return slack_bot_member_id
     except SlackApiError as e:
         logging.error(f"Error running auth.test: {e.response['error']}")
         return None
 
-# Start a background thread to monitor configuration changes
+# Bot member ID of a project, fetched on first use if auth.test has not finished yet
+def get_project_bot_member_id(project):
+    return project.get('slack_bot_member_id') or get_slack_bot_member_id(project['slack_bot_token'])
+
+# Run auth.test for new tokens in parallel, tokens that time out are tried again on the next reload
+def fetch_bot_member_ids(tokens, timeout=10):
+    tokens = [token for token in tokens if token not in bot_member_ids]
+    if not tokens:
+        return
+    executor = ThreadPoolExecutor(max_workers=min(len(tokens), 16))
+    futures = [executor.submit(get_slack_bot_member_id, token) for token in tokens]
+    done, not_done = wait(futures, timeout=timeout)
+    if not_done:
+        logging.error(f"auth.test did not finish in {timeout}s for {len(not_done)} Slack tokens")
+    executor.shutdown(wait=False)
+
+# Start a background thread to monitor configuration changes. Changes of config.yaml
+# are noticed at once through filesystem notifications when watchdog is installed,
+# the file is also checked every interval seconds.
 def start_config_monitor(interval=60):
+    config_changed = threading.Event()
+    if Observer is not None:
+        try:
+            start_config_watcher(config_changed)
+        except Exception as e:
+            logging.warning(f"Config file notifications are not available, polling every {interval}s: {str(e)}")
+
     def monitor():
         while True:
             check_and_reload_config()
-            time.sleep(interval)
+            if config_changed.wait(interval):
+                # Let the editor finish writing the file
+                time.sleep(0.2)
+                config_changed.clear()
     monitor_thread = threading.Thread(target=monitor)
     monitor_thread.start()
     logging.debug(f"Config change monitoring started")
     return monitor_thread
 
+def start_config_watcher(config_changed):
+    config_path = os.path.abspath(CONFIG_PATH)
+
+    class ConfigEventHandler(FileSystemEventHandler):
+        def on_any_event(self, event):
+            paths = [getattr(event, 'src_path', None), getattr(event, 'dest_path', None)]
+            if config_path in [os.path.abspath(path) for path in paths if path]:
+                config_changed.set()
+
+    observer = Observer()
+    # Editors often replace the file, so the directory is watched
+    observer.schedule(ConfigEventHandler(), os.path.dirname(config_path))
+    observer.daemon = True
+    observer.start()
+    return observer
+
 def check_and_reload_config():
     global config_last_loaded_time
-    config_path = 'config.yaml'
+    config_path = CONFIG_PATH
     try:
         last_modified_time = os.path.getmtime(config_path)
         # If the configuration has changed (by the time the file was changed)
@@ -124,55 +245,110 @@ def check_and_reload_config():
     except Exception as e:
         logging.error(f"Error checking configuration: {str(e)}")
 
-# Function for loading configuration
-def load_config():
-    global current_config, config_last_loaded_time
+# Functions called with the new config after every successful load
+config_listeners = []
+
+# Project settings without the values added by the gate
+def project_settings(project):
+    return {key: value for key, value in project.items() if key != 'slack_bot_member_id'}
+
+# Function for loading configuration. Only added or changed projects are processed,
+# unchanged projects keep their objects from the previous config.
+# With check_tokens=False auth.test runs in the background and does not delay the startup.
+def load_config(check_tokens=True):
+    global current_routes, config_last_loaded_time
     try:
-        with open('config.yaml', 'r') as f:
+        with open(CONFIG_PATH, 'r') as f:
             new_config = yaml.safe_load(f)
-            current_config = new_config
-            config_last_loaded_time = time.time()
-            logging.debug("Configuration file updated.")
-            
-            # Get and save slack_bot_member_id for each active project
-            for project in current_config['channels']:
-                if project.get('active', False):  # Check if 'active' is True
-                    slack_token = project['slack_bot_token']
-                    project['slack_bot_member_id'] = get_slack_bot_member_id(slack_token)
-            
-            return current_config
+
+        old_projects = {project['project_name']: project for project in current_routes.config.get('channels') or []}
+        old_tokens = {project['slack_bot_token'] for project in old_projects.values()}
+        settings = new_config.get('settings') or {}
+
+        changed_projects = []
+        channels = []
+        for project in new_config.get('channels') or []:
+            old_project = old_projects.get(project['project_name'])
+            if old_project is not None and project_settings(old_project) == project:
+                channels.append(old_project)
+            else:
+                changed_projects.append(project)
+                channels.append(project)
+
+        # Get slack_bot_member_id for each added or changed active project
+        active_tokens = {project['slack_bot_token'] for project in changed_projects if project.get('active', False)}
+        if check_tokens:
+            fetch_bot_member_ids(active_tokens, timeout=settings.get('auth_timeout', 10))
+        else:
+            threading.Thread(target=fetch_bot_member_ids, args=(active_tokens, settings.get('auth_timeout', 10)), daemon=True).start()
+        for project in changed_projects:
+            if project.get('active', False):  # Check if 'active' is True
+                project['slack_bot_member_id'] = bot_member_ids.get(project['slack_bot_token'])
+        new_config['channels'] = channels
+
+        # The new config is complete before readers can see it
+        current_routes = build_routes(new_config)
+        prune_slack_clients(new_config)
+        user_cache.ttl = settings.get('user_cache_ttl', 3600)
+        preload_slack_users(active_tokens - old_tokens)
+        for listener in config_listeners:
+            try:
+                listener(new_config)
+            except Exception as e:
+                logging.error(f"Error applying the new configuration: {str(e)}")
+        config_last_loaded_time = time.time()
+        logging.info(f"Configuration file updated, {len(changed_projects)} of {len(channels)} projects added or changed.")
+
+        return new_config
     except Exception as e:
         logging.error(f"Error loading configuration: {str(e)}")
 
-# Function to get external IP address
-def get_server_ip():
-    while True:
+# Public URL of the gate: GATE_PUBLIC_URL, settings.public_url or, if
+# discover_public_ip is enabled, the external IP address of the server
+def get_public_url(settings):
+    public_url = os.environ.get('GATE_PUBLIC_URL') or settings.get('public_url')
+    if public_url:
+        return public_url.rstrip('/')
+    if settings.get('discover_public_ip', True):
+        sip = get_server_ip()
+        if sip:
+            return f'http://{sip}:5555'
+    return None
+
+# Function to get external IP address, None if it cannot be found in a few attempts
+def get_server_ip(timeout=3, attempts=2):
+    for attempt in range(attempts):
         try:
             ip_url = 'https://httpbin.org/ip'
-            response = requests.get(ip_url)
+            response = requests.get(ip_url, timeout=timeout)
             data = response.json()
             sip = data.get('origin')
             return sip
-        except:
-            time.sleep(5)
+        except Exception as e:
+            logging.warning(f"Error getting the external IP address: {str(e)}")
+    return None
 
 # Function for downloading files from Slack
+@metrics.stage_seconds.time(stage='media_download')
 def download_file_from_slack(file_url, slack_token):
     headers = {
         'Authorization': f'Bearer {slack_token}'
     }   
     
+    local_filepath = None
     try:
-        file_response = requests.get(file_url, headers=headers, stream=True, timeout=60)
+        file_response = get_http_session('slack').get(file_url, headers=headers, stream=True, timeout=60)
         
         if file_response.status_code == 200:
+            # Each download gets its own directory, so files with the same name never collide
+            # and Telegram still receives the original file name
             local_filename = file_url.split("/")[-1]
-            local_filepath = f'/tmp/{local_filename}'
+            local_filepath = os.path.join(tempfile.mkdtemp(prefix='slack-file-'), local_filename)
 
             logging.debug(f"Uploading a file from Slack. Expected content type: {file_response.headers.get('Content-Type')}")
 
             with open(local_filepath, 'wb') as f:
-                for chunk in file_response.iter_content(chunk_size=1024):
+                for chunk in file_response.iter_content(chunk_size=1024 * 1024):
                     if chunk:
                         f.write(chunk)
 
@@ -183,86 +359,90 @@ def download_file_from_slack(file_url, slack_token):
         else:
             logging.error(f"Error uploading file from Slack: {file_url}, status: {file_response.status_code}")
             return None
-    except requests.exceptions.RequestException as e:
+    except (requests.exceptions.RequestException, OSError) as e:
         logging.error(f"Error uploading file from Slack: {str(e)}")
+        # A download that broke off leaves a partial file behind
+        if local_filepath:
+            remove_downloaded_file(local_filepath)
         return None
 
+# Remove a file downloaded by download_file_from_slack together with its directory
+def remove_downloaded_file(local_filepath):
+    shutil.rmtree(os.path.dirname(local_filepath), ignore_errors=True)
+
 def update_slack_thread_ts_by_string(event, project):
+    # Fast path: only file messages posted by our own bot can have a file id mapping
+    if not project or not event.get('files'):
+        return
+    slack_bot_member_id = get_project_bot_member_id(project)
+    if slack_bot_member_id and event.get('user') != slack_bot_member_id:
+        return
+
     logging.debug(f"Processing message for project_name={project['project_name']}, event_ts={event.get('event_ts')}, slack_thread_ts={event.get('slack_thread_ts')}")
-    time.sleep(4)
-    queue_processed_event.wait() 
     try:
-        with lock:
-            if 'files' in event and len(event['files']) > 0:
-                file_info = event['files'][0]
-                timestamp = str(file_info.get('id', ''))
-            else:
-                logging.debug("Could not find file or timestamp in this 'event''")
-                return
-
-            event_ts = str(event.get('event_ts', ''))
-            if not event_ts:
-                logging.debug("Could not find event_ts in event")
-                return
-
-            project_name = project['project_name']
-
-            logging.debug(f"timestamp: {type(timestamp)}: {timestamp}")
-            logging.debug(f"event_ts: {type(event_ts)}: {event_ts}")
-            logging.debug(f"project_name: {type(project_name)}: {project_name}")
-
-            # Wait for all requests in the queue to be processed
-            queue_processed_event.wait() 
-            
-            # Search for an entry with timestamp and project_name in the database
-            cursor.execute('''
-            SELECT telegram_message_id FROM message_threads 
-            WHERE slack_thread_ts = ? AND project_name = ?
-            ''', (timestamp, project_name))
-            
-            result = cursor.fetchone()
-
-            if result:
-                telegram_message_id = result[0]
-                logging.debug(f"Found telegram_message_id: {telegram_message_id}")
-                save_thread_ts(telegram_message_id, event_ts, project_name)
-            else:
-                logging.debug(f"Entry with slack_thread_ts={timestamp} for project {project_name} was not found in the database.")
-                       
+        timestamp = str(event['files'][0].get('id', ''))
+        event_ts = str(event.get('event_ts', ''))
+        if not event_ts:
+            logging.debug("Could not find event_ts in event")
+            return
+
+        project_name = project['project_name']
+        timeout = current_routes.config['settings'].get('file_mapping_timeout', 10)
+
+        # Wait until send_media_to_slack saves the file id of this upload
+        telegram_message_id = wait_for_telegram_message_id(timestamp, project_name, timeout)
+        if telegram_message_id is not None:
+            logging.debug(f"Found telegram_message_id: {telegram_message_id}")
+            save_thread_ts(telegram_message_id, event_ts, project_name)
+        else:
+            logging.debug(f"Entry with slack_thread_ts={timestamp} for project {project_name} was not found in {timeout}s.")
+
     except Exception as e:
         logging.error(f"Error updating message with slack_thread_ts={event.get('slack_thread_ts')}: {str(e)}")
 
+# Wait for the mapping slack_thread_ts -> telegram_message_id to become visible
+def wait_for_telegram_message_id(slack_thread_ts, project_name, timeout):
+    return mapping_store.wait_for_telegram_message_id(slack_thread_ts, project_name, timeout)
+
 def save_thread_ts(telegram_message_id, slack_thread_ts, project_name):
     try:
-        # Add an update request to the queue
-        query_queue.put((
-            '''
-            INSERT OR REPLACE INTO message_threads (telegram_message_id, slack_thread_ts, project_name)
-            VALUES (?, ?, ?)
-            ''', (telegram_message_id, slack_thread_ts, project_name)
-        ))
+        # Mapping is visible to readers at once, returns the sequence number of the queued write
+        return mapping_store.save(telegram_message_id, slack_thread_ts, project_name)
     except ValueError as ve:
         logging.error(f"Error while converting data: {ve}")
 
+# Slack user display names, cached per workspace (bot token)
+user_cache = SlackUserCache()
+
 def get_slack_username(slack_client, slack_user_id):
-    try:
-        # Get user information via Slack API
-        user_info = slack_client.users_info(user=slack_user_id)
-        # Username or real name
-        slack_username = user_info['user'].get('real_name') or user_info['user'].get('name')
-        return slack_username
-    except SlackApiError as e:
-        logging.error(f"Error getting Slack user information: {e.response['error']}")
-        return "Unknown User"
-    
+    def fetch(user_id):
+        try:
+            # Get user information via Slack API
+            user_info = slack_client.users_info(user=user_id)
+            # Username or real name
+            return get_display_name(user_info['user'])
+        except SlackApiError as e:
+            logging.error(f"Error getting Slack user information: {e.response['error']}")
+            return None
+
+    return user_cache.get(slack_client.token, slack_user_id, fetch) or "Unknown User"
+
+# Warm the user cache for the workspaces of the given bot tokens in a background thread
+def preload_slack_users(tokens):
+    if not tokens:
+        return
+
+    def preload():
+        for slack_bot_token in tokens:
+            user_cache.preload(slack_bot_token, get_slack_client(slack_bot_token))
+
+    threading.Thread(target=preload, daemon=True).start()
+
 # Function for getting message_id from the database by thread_ts and project_name
 def get_telegram_message_id_by_thread_ts(thread_ts, project_name):
-    cursor.execute('SELECT telegram_message_id FROM message_threads WHERE slack_thread_ts = ? AND project_name = ?', (thread_ts, project_name))
-    result = cursor.fetchone()
-    if result:
-        return result[0]
-    return None
+    return mapping_store.get_telegram_message_id(thread_ts, project_name)
 
+@metrics.stage_seconds.time(stage='mapping_lookup')
 def process_reply_to_message(event, project):
     thread_ts = event.get('thread_ts') or event.get('ts')
     reply_to_message_id = None